@@ -1,18 +1,97 @@
 # coding: utf-8
 # app.py by N1k0droid\\IT9KVB update 14.08.25
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 import json
+import math
 import time
 import re
+import os
+import atexit
+from aprs_logging import get_logger
+from observation_history import ObservationHistory
+from observation_archive import ObservationArchive
+from latest_observation import (LatestObservation, LatestObservationReader, read_latest_observation,
+                                SERVICE_STATS_PATH)
+from wx_aggregates import RAW_FIELDS
+from metrics import registry
+from rate_limit import limiter
+import profiling
+from delivery import STATS_PATH as DELIVERY_STATS_PATH
 
 app = Flask(__name__)
+log = get_logger("app")
 DATA_PATH = "/config/meteo.json"
 start_time = time.time()
+# Recent samples shared by every receiver process through /dev/shm
+history = ObservationHistory()
+# Latest observation is shared with the daemon through shared memory;
+# DATA_PATH is only refreshed as a periodic snapshot
+latest = LatestObservation(snapshot_path=DATA_PATH)
+# Long-term binary archive with 1m/1h/1d rollups under /config/archive
+archive = ObservationArchive()
+
+
+def flush_buffers():
+    """
+    Write the buffered archive samples and the meteo.json snapshot.
+    Receiver processes are forked and exit through os._exit, which skips
+    atexit, so their entry points call this when they stop.
+    """
+    archive.flush()
+    latest.write_snapshot()
+
+
+atexit.register(flush_buffers)
+
+# Realistic limits for the known weather parameters
+LIMITS = {
+    'temperature': (-50, 70),     # °C - extreme but realistic range
+    'humidity': (0, 100),         # % - standard range
+    'pressure': (800, 1200),      # hPa - valid barometric range
+    'wind_speed': (0, 100),       # m/s - up to 360 km/h
+    'wind_direction': (0, 360),   # degrees - wind direction
+    'wind_gust': (0, 150),        # m/s - more intense gusts
+    'rain_1h': (0, 200),          # mm - maximum hourly rain
+    'rain_24h': (0, 1000),        # mm - maximum daily rain
+    'dewpoint': (-60, 50),        # °C - dew point
+    'rain_tips': (0, 10000),      # raw tipping-bucket tips since last sample
+    'rain_midnight': (0, 1000),   # mm - rain since local midnight
+    'rain_counter': (0, 2**32)    # raw cumulative tipping-bucket counter
+}
+
+BATCH_MAX_ROWS = int(os.getenv('BATCH_MAX_ROWS', '10000'))
+BATCH_MAX_BYTES = int(os.getenv('BATCH_MAX_BYTES', str(4 * 1024 * 1024)))
+# Row timestamps may be at most this many seconds ahead of the receiver clock
+BATCH_MAX_CLOCK_SKEW = int(os.getenv('BATCH_MAX_CLOCK_SKEW', '60'))
+
+# Ingest metrics; the daemon publishes its own through the shared metrics directory
+INSTRUMENTED_ENDPOINTS = {'meteo', 'meteo_batch'}
+REQUESTS = registry.counter('aprs_http_requests_total', "Ingest requests by endpoint, method and status",
+                            ('endpoint', 'method', 'status'))
+REQUEST_SECONDS = registry.histogram('aprs_http_request_duration_seconds', "Ingest request latency",
+                                     ('endpoint',))
+RATE_LIMITED = registry.counter('aprs_rate_limited_total', "Ingest requests rejected by the rate limiter",
+                                ('endpoint',))
+VALIDATION = registry.counter('aprs_validation_total', "Validated weather fields by field and result",
+                              ('field', 'result'))
+
+def _field_label(key):
+    # Unknown parameters share one label to keep the series count bounded
+    return key if key in LIMITS else 'other'
+
+def _finite(value):
+    if not math.isfinite(value):
+        raise ValueError(f"{value} is not a finite number")
+    return value
 
 def safe_float_conversion(value_str):
-    """Convert string to float supporting both comma and dot as decimal separator"""
+    """Convert string to float supporting both comma and dot as decimal separator
+    Booleans raise TypeError, NaN and infinities ValueError
+    """
+    if isinstance(value_str, bool):
+        raise TypeError("boolean is not a measurement")
     if not isinstance(value_str, str):
-        return float(value_str)  # If already a number, convert directly
+        return _finite(float(value_str))  # If already a number, convert directly
     
     # Remove spaces
     value_str = value_str.strip()
@@ -22,24 +101,14 @@ def safe_float_conversion(value_str):
     value_str = value_str.replace(',', '.')
     
     try:
-        return float(value_str)
+        return _finite(float(value_str))
     except ValueError as e:
-        print(f"Conversion error '{value_str}': {e}")
+        log.debug("Conversion error '%s': %s", value_str, e)
         raise
 
 def validate_weather_data(data):
     """Validate received weather data with realistic limits and decimal comma support"""
-    limits = {
-        'temperature': (-50, 70),     # °C - extreme but realistic range
-        'humidity': (0, 100),         # % - standard range
-        'pressure': (800, 1200),      # hPa - valid barometric range
-        'wind_speed': (0, 100),       # m/s - up to 360 km/h
-        'wind_direction': (0, 360),   # degrees - wind direction
-        'wind_gust': (0, 150),        # m/s - more intense gusts
-        'rain_1h': (0, 200),          # mm - maximum hourly rain
-        'rain_24h': (0, 1000),        # mm - maximum daily rain
-        'dewpoint': (-60, 50)         # °C - dew point
-    }
+    limits = LIMITS
     
     validated = {}
     rejected = {}
@@ -53,36 +122,238 @@ def validate_weather_data(data):
                 min_val, max_val = limits[key]
                 if min_val <= numeric_value <= max_val:
                     validated[key] = numeric_value
-                    print(f"VALID {key}: {value} -> {numeric_value}")
+                    log.debug("VALID %s: %s -> %s", key, value, numeric_value)
                 else:
                     rejected[key] = value
-                    print(f"REJECTED {key}: {value} -> {numeric_value} - valid range [{min_val}, {max_val}]")
+                    log.debug("REJECTED %s: %s -> %s - valid range [%s, %s]", key, value, numeric_value, min_val, max_val)
             else:
                 # Unmapped parameters - accept anyway if numeric
                 validated[key] = numeric_value
-                print(f"UNMAPPED {key}: {value} -> {numeric_value} (unmapped parameter, accepted)")
+                log.debug("UNMAPPED %s: %s -> %s (unmapped parameter, accepted)", key, value, numeric_value)
                 
         except (ValueError, TypeError):
             rejected[key] = value
-            print(f"REJECTED {key}: {value} - numeric conversion failed")
+            log.debug("REJECTED %s: %s - numeric conversion failed", key, value)
     
     if rejected:
-        print(f"WARNING: {len(rejected)} parameters rejected: {list(rejected.keys())}")
+        log.warning("%d parameters rejected: %s", len(rejected), list(rejected.keys()))
+
+    VALIDATION.inc_many([(_field_label(key), 'accepted') for key in validated] +
+                        [(_field_label(key), 'rejected') for key in rejected])
     
     return validated, rejected
 
+def _without_raw(data):
+    return {k: v for k, v in data.items() if k not in RAW_FIELDS}
+
+def record_observation(validated_data, timestamp, publish=True):
+    """Store a validated sample; returns the observation without raw rain inputs
+    Raw inputs only go to the shared history, where the daemon derives rain totals and gust.
+    publish=False leaves the shared latest observation to the caller (UDP bursts)
+    """
+    history.append(timestamp, validated_data)
+    observation = _without_raw(validated_data)
+    if publish:
+        latest.publish(observation, timestamp)
+    archive.append(timestamp, observation)
+    return observation
+
+def _to_float_column(values):
+    """
+    Convert a column in one pass: bulk comma-decimal normalization, None on
+    failure. Rejects the same values as safe_float_conversion.
+    """
+    normalized = [v.strip().replace(',', '.') if isinstance(v, str) else v for v in values]
+    out = []
+    append = out.append
+    for v in normalized:
+        if v is None or isinstance(v, bool):
+            append(None)
+            continue
+        try:
+            v = float(v)
+        except (ValueError, TypeError):
+            append(None)
+            continue
+        append(v if math.isfinite(v) else None)
+    return out
+
+def validate_weather_batch(rows):
+    """
+    Validate a batch of observations column by column.
+    Returns (timestamps, validated_rows, rejected_rows): one entry per input row,
+    timestamps[i] is None when the row timestamp is invalid, not positive or
+    more than BATCH_MAX_CLOCK_SKEW seconds in the future.
+    """
+    count = len(rows)
+    now = time.time()
+    validated = [{} for _ in range(count)]
+    rejected = [{} for _ in range(count)]
+
+    # A future-dated row would break the time order of the history and block later publishes
+    newest_allowed = now + BATCH_MAX_CLOCK_SKEW
+    timestamps = [ts if ts is not None and 0 < ts <= newest_allowed else None
+                  for ts in _to_float_column([row.get('timestamp', now) for row in rows])]
+
+    keys = set()
+    for row in rows:
+        keys.update(row)
+    keys.discard('timestamp')
+
+    for key in keys:
+        raw = [row.get(key) for row in rows]
+        present = [key in row for row in rows]
+        column = _to_float_column(raw)
+        min_val, max_val = LIMITS.get(key, (float('-inf'), float('inf')))
+        # Range mask over the whole column
+        mask = [v is not None and min_val <= v <= max_val for v in column]
+        accepted_count = sum(1 for i in range(count) if present[i] and mask[i])
+        VALIDATION.add(accepted_count, _field_label(key), 'accepted')
+        VALIDATION.add(sum(present) - accepted_count, _field_label(key), 'rejected')
+        for i in range(count):
+            if not present[i]:
+                continue
+            if mask[i]:
+                validated[i][key] = column[i]
+            else:
+                rejected[i][key] = raw[i]
+
+    return timestamps, validated, rejected
+
+def _parse_batch_body(body):
+    """Parse a JSON array or NDJSON request body into a list of dicts"""
+    body = body.decode('utf-8')
+    stripped = body.lstrip()
+    if stripped.startswith('['):
+        rows = json.loads(stripped)
+    else:
+        rows = [json.loads(line) for line in body.splitlines() if line.strip()]
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        raise ValueError("batch must be a JSON array or NDJSON stream of objects")
+    return rows
+
+@app.before_request
+def _start_timer():
+    if request.endpoint in INSTRUMENTED_ENDPOINTS:
+        g.request_started = time.perf_counter()
+
+@app.before_request
+def _rate_limit():
+    """Reject over-budget clients with 429 before the body is read or parsed"""
+    if request.endpoint not in INSTRUMENTED_ENDPOINTS or not limiter.enabled:
+        return None
+    key = limiter.client_key(request.remote_addr, request.headers.get('X-Station-Key'))
+    retry_after = limiter.allow(key)
+    if not retry_after:
+        return None
+    RATE_LIMITED.inc(request.url_rule.rule)
+    log.debug("Rate limit exceeded by %s", key)
+    return app.response_class(b'{"error":"Too many requests"}\n', status=429, mimetype='application/json',
+                              headers={'Retry-After': str(int(retry_after) + 1)})
+
+@app.after_request
+def _record_request(response):
+    stages = profiling.current()
+    if stages:
+        stages.lap('respond')
+        response.headers['Server-Timing'] = stages.header()
+        profiling.end()
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule
+        REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint)
+        REQUESTS.inc(endpoint, request.method, str(response.status_code))
+    return response
+
+@app.route('/meteo/batch', methods=['POST'])
+def meteo_batch():
+    """Ingest many timestamped observations (JSON array or NDJSON) in one request"""
+    client_ip = request.remote_addr
+    # Bound the body before reading it; chunked bodies are cut at the limit
+    body = None
+    if (request.content_length or 0) <= BATCH_MAX_BYTES:
+        body = request.stream.read(BATCH_MAX_BYTES + 1)
+    if body is None or len(body) > BATCH_MAX_BYTES:
+        return jsonify({"error": f"Batch too large: maximum {BATCH_MAX_BYTES} bytes"}), 413
+    try:
+        rows = _parse_batch_body(body)
+    except ValueError as e:
+        return jsonify({
+            "error": f"Invalid batch payload: {e}",
+            "help": "POST a JSON array or NDJSON lines of objects with optional 'timestamp' (unix seconds)"
+        }), 400
+
+    if not rows:
+        return jsonify({"error": "Empty batch"}), 400
+    if len(rows) > BATCH_MAX_ROWS:
+        return jsonify({"error": f"Batch too large: {len(rows)} rows, maximum {BATCH_MAX_ROWS}"}), 413
+
+    timestamps, validated_rows, rejected_rows = validate_weather_batch(rows)
+
+    results = []
+    accepted = []
+    for i, (ts, validated, rejected) in enumerate(zip(timestamps, validated_rows, rejected_rows)):
+        if ts is None:
+            results.append({"index": i, "status": "rejected", "error": "invalid timestamp"})
+            continue
+        result = {"index": i, "status": "accepted" if validated else "rejected"}
+        if validated:
+            result["accepted_params"] = list(validated.keys())
+            accepted.append((ts, validated, result))
+        if rejected:
+            result["rejected_params"] = list(rejected.keys())
+        results.append(result)
+
+    # The ring buffer is time ordered: only samples newer than the last one are stored
+    accepted.sort(key=lambda item: item[0])
+    last_ts = history.last_timestamp()
+    stored = []
+    for ts, validated, result in accepted:
+        # Another process may have stored a newer sample in the meantime
+        if (last_ts is not None and ts < last_ts) or history.append(ts, validated, strict=True) is None:
+            result["status"] = "rejected"
+            result["error"] = "older than newest sample"
+            del result["accepted_params"]
+            continue
+        observation = _without_raw(validated)
+        archive.append(ts, observation)
+        stored.append((ts, observation))
+        last_ts = ts
+    accepted = stored
+
+    if accepted:
+        newest_ts, newest = accepted[-1]
+        current = latest.latest
+        if current is None or newest_ts >= current[1]:
+            try:
+                latest.publish(newest, newest_ts)
+            except Exception as e:
+                log.error("Data save error: %s", e)
+                return jsonify({"error": f"Data save error: {str(e)}"}), 500
+
+    log.info("Weather batch from IP %s: %d rows, %d accepted", client_ip, len(rows), len(accepted))
+    return jsonify({
+        "status": "ok" if accepted else "rejected",
+        "rows": len(rows),
+        "accepted": len(accepted),
+        "rejected": len(rows) - len(accepted),
+        "results": results,
+        "timestamp": time.time()
+    }), 200 if accepted else 400
+
 @app.route('/meteo', methods=['GET', 'POST'])
 def meteo():
     data = None
     client_ip = request.remote_addr
-    print(f"Weather request from IP: {client_ip}")
+    # Opt-in (APRS_PROFILE=on) timings of parse, validate, persist and respond
+    stages = profiling.begin('meteo')
 
     # Try to read JSON from body if POST
     if request.method == 'POST':
         try:
             data = request.get_json(force=True)
         except Exception as e:
-            print(f"JSON parsing error: {e}")
+            log.debug("JSON parsing error: %s", e)
             data = None
 
     # If no JSON body, try to read parameters from query string
@@ -90,7 +361,8 @@ def meteo():
         # List of all possible parameters
         param_names = [
             'temperature', 'humidity', 'pressure', 'wind_speed', 
-            'wind_direction', 'wind_gust', 'rain_1h', 'rain_24h', 'dewpoint'
+            'wind_direction', 'wind_gust', 'rain_1h', 'rain_24h', 'dewpoint',
+            'rain_midnight', 'rain_tips', 'rain_counter'
         ]
         
         data = {}
@@ -106,10 +378,12 @@ def meteo():
             "decimal_format": "Both dot (22.5) and comma (22,5) supported"
         }), 400
 
-    print(f"Received data: {data}")
+    log.debug("Received data from IP %s: %s", client_ip, data)
+    stages.lap('parse')
     
     # DATA VALIDATION with decimal comma support
     validated_data, rejected_data = validate_weather_data(data)
+    stages.lap('validate')
     
     if not validated_data:
         return jsonify({
@@ -118,16 +392,17 @@ def meteo():
             "limits_info": "Check parameter ranges in logs"
         }), 400
 
-    # Save only validated data
+    # Publish only validated data
     try:
-        with open(DATA_PATH, 'w') as f:
-            json.dump(validated_data, f, indent=2)
+        timestamp = time.time()
+        validated_data = record_observation(validated_data, timestamp)
+        stages.lap('persist')
         
         response_data = {
             "status": "ok",
             "accepted": len(validated_data),
             "accepted_params": list(validated_data.keys()),
-            "timestamp": time.time(),
+            "timestamp": timestamp,
             "decimal_support": "comma and dot supported"
         }
         
@@ -135,47 +410,178 @@ def meteo():
             response_data["rejected"] = len(rejected_data)
             response_data["rejected_params"] = list(rejected_data.keys())
         
-        print(f"Weather data saved: {validated_data}")
+        log.info("Weather data from IP %s accepted: %s", client_ip, validated_data)
         return jsonify(response_data)
         
     except Exception as e:
-        print(f"File save error: {e}")
-        return jsonify({"error": f"File save error: {str(e)}"}), 500
+        log.error("Data save error: %s", e)
+        return jsonify({"error": f"Data save error: {str(e)}"}), 500
+
+@app.route('/history', methods=['GET'])
+def history_query():
+    """Return stored observations in a time range, optionally downsampled
+    Parameters: start/end (unix time), since (seconds back), step (bucket seconds), fields (comma list)
+    """
+    start = request.args.get('start', type=float)
+    end = request.args.get('end', type=float)
+    step = request.args.get('step', type=float)
+    since = request.args.get('since', type=float)
+    if since is not None and start is None:
+        start = time.time() - since
+    fields = request.args.get('fields')
+    fields = [f.strip() for f in fields.split(',') if f.strip()] if fields else None
+
+    result = history.query(start=start, end=end, step=step, fields=fields)
+    result["count"] = len(result["timestamps"])
+    result["capacity"] = history.capacity
+    return jsonify(result)
+
+@app.route('/archive', methods=['GET'])
+def archive_query():
+    """Return archived observations from disk
+    Parameters: start/end (unix time), since (seconds back), fields (comma list),
+    resolution (raw, 1m, 1h, 1d or auto)
+    """
+    start = request.args.get('start', type=float)
+    end = request.args.get('end', type=float)
+    since = request.args.get('since', type=float)
+    if since is not None and start is None:
+        start = time.time() - since
+    fields = request.args.get('fields')
+    fields = [f.strip() for f in fields.split(',') if f.strip()] if fields else None
+    try:
+        result = archive.query(start=start, end=end, fields=fields,
+                               resolution=request.args.get('resolution', 'auto'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    result["count"] = len(result["timestamps"])
+    return jsonify(result)
+
+STATUS_FEATURES = {
+    "decimal_support": "comma and dot (22,5 or 22.5)",
+    "validation": "enabled with realistic ranges",
+    "parameters": ["temperature", "humidity", "pressure", "wind_speed", "wind_direction", "wind_gust", "rain_1h", "rain_24h", "dewpoint"]
+}
+latest_reader = LatestObservationReader()
+# (version, last data, data timestamp): rebuilt only when a new observation is published
+_status_cache = None
+
+def _latest_status():
+    """Latest observation for /status, reloaded only when its version changes.
+    The version is the shared segment sequence, or the snapshot file mtime
+    before anything was published since the container started.
+    """
+    global _status_cache
+    seq = latest_reader.sequence()
+    if seq:
+        version = f"s{seq}"
+    else:
+        try:
+            version = f"f{os.stat(DATA_PATH).st_mtime_ns}"
+        except OSError:
+            version = "none"
+    if _status_cache is not None and _status_cache[0] == version:
+        return _status_cache
+
+    last_data, data_timestamp = None, None
+    current = latest_reader.read() if seq else None
+    if current is not None:
+        last_data, data_timestamp = current
+    elif version.startswith('f'):
+        with open(DATA_PATH, 'r') as f:
+            last_data = json.load(f)
+        data_timestamp = os.path.getmtime(DATA_PATH)
+    _status_cache = (version, last_data, data_timestamp)
+    return _status_cache
+
+# path -> (file mtime, statistics) for the JSON files published by the other processes
+_stats_cache = {}
+
+def _shared_stats(path):
+    """Statistics file written by the daemon or the service manager, reloaded when it changes.
+    Returns (version, statistics), (None, None) when the file does not exist.
+    """
+    try:
+        version = os.stat(path).st_mtime_ns
+    except OSError:
+        return None, None
+    cached = _stats_cache.get(path)
+    if cached is None or cached[0] != version:
+        try:
+            with open(path) as f:
+                cached = (version, json.load(f))
+        except (OSError, ValueError):
+            return None, None
+        _stats_cache[path] = cached
+    return cached
+
+def _not_modified(etag, last_modified=None):
+    """304 response when the client's cached copy is current, otherwise None.
+    Checked before building the body so polling clients cost almost nothing.
+    """
+    if request.if_none_match:
+        matched = request.if_none_match.contains_weak(etag)
+    elif last_modified is not None and request.if_modified_since is not None:
+        matched = int(last_modified) <= request.if_modified_since.timestamp()
+    else:
+        matched = False
+    if not matched:
+        return None
+    response = app.response_class(status=304)
+    response.set_etag(etag, weak=True)
+    return response
+
+def _cacheable(response, etag, last_modified=None):
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
 
 @app.route('/health', methods=['GET'])
 def health():
     """Endpoint for healthcheck"""
-    return jsonify({
+    # Weak validator: uptime is the only part that changes
+    etag = "health"
+    return _not_modified(etag) or _cacheable(jsonify({
         "status": "healthy",
         "uptime": time.time() - start_time,
         "decimal_support": "Both comma and dot decimal separators supported"
-    })
+    }), etag)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text exposition covering the receiver and the daemon"""
+    current = read_latest_observation() or latest.latest
+    age = time.time() - current[1] if current is not None else float('nan')
+    body = registry.render(gauges=[
+        ('aprs_last_observation_age_seconds', "Seconds since the last accepted observation", age),
+        ('aprs_receiver_uptime_seconds', "Seconds since the receiver started", time.time() - start_time),
+    ])
+    return body, 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 @app.route('/status', methods=['GET'])
 def status():
-    """Endpoint for complete system monitoring"""
+    """Endpoint for complete system monitoring
+    Served from an in-memory snapshot; ETag/Last-Modified follow the latest observation.
+    """
     try:
-        import os
-        # Read last transmission
-        if os.path.exists(DATA_PATH):
-            with open(DATA_PATH, 'r') as f:
-                last_data = json.load(f)
-            data_timestamp = os.path.getmtime(DATA_PATH)
-        else:
-            last_data = None
-            data_timestamp = None
-            
-        return jsonify({
+        version, last_data, data_timestamp = _latest_status()
+        delivery_version, delivery = _shared_stats(DELIVERY_STATS_PATH)
+        services_version, services = _shared_stats(SERVICE_STATS_PATH)
+        # Same tag from every worker process; the timestamp tells apart a reset segment
+        etag = f"status-{version}-{data_timestamp}-{delivery_version}-{services_version}"
+        # These statistics change without a new observation: no Last-Modified shortcut then
+        last_modified = data_timestamp if delivery is None and services is None else None
+        return _not_modified(etag, last_modified) or _cacheable(jsonify({
             "status": "running",
             "last_weather_data": last_data,
             "last_update": data_timestamp,
+            "delivery": delivery,
+            "services": services,
             "uptime": time.time() - start_time,
-            "features": {
-                "decimal_support": "comma and dot (22,5 or 22.5)",
-                "validation": "enabled with realistic ranges",
-                "parameters": ["temperature", "humidity", "pressure", "wind_speed", "wind_direction", "wind_gust", "rain_1h", "rain_24h", "dewpoint"]
-            }
-        })
+            "features": STATUS_FEATURES
+        }), etag, last_modified)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
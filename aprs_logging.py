@@ -0,0 +1,118 @@
+# coding: utf-8
+# aprs_logging.py - shared logging setup for the receiver, sender and daemon
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()          # text or json
+LOG_RATE_LIMIT = int(os.getenv('LOG_RATE_LIMIT', '20'))        # messages per template
+LOG_RATE_WINDOW = float(os.getenv('LOG_RATE_WINDOW', '10'))    # seconds
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+
+_listener = None
+_setup_lock = threading.Lock()
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Allow at most `limit` records per message template every `window` seconds.
+    Suppressed records are counted and reported with the next allowed one.
+    Errors are never dropped.
+    """
+
+    def __init__(self, limit=LOG_RATE_LIMIT, window=LOG_RATE_WINDOW):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if self.limit <= 0 or record.levelno >= logging.ERROR:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            window_start, count, suppressed = self.buckets.get(key, (now, 0, 0))
+            if now - window_start >= self.window:
+                window_start, count = now, 0
+            if count >= self.limit:
+                self.buckets[key] = (window_start, count, suppressed + 1)
+                return False
+            self.buckets[key] = (window_start, count + 1, 0)
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
+
+
+def setup_logging(debug=False):
+    """
+    Configure the root logger once per process: records are put on a queue
+    and written to stdout by a background listener thread.
+    """
+    global _listener
+    with _setup_lock:
+        level = logging.DEBUG if debug else getattr(logging, LOG_LEVEL, logging.INFO)
+        root = logging.getLogger()
+        root.setLevel(level)
+        if _listener is not None:
+            return
+
+        stream = logging.StreamHandler(sys.stdout)
+        if LOG_FORMAT == 'json':
+            stream.setFormatter(JSONFormatter())
+        else:
+            stream.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+        log_queue = queue.SimpleQueue()
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        queue_handler.addFilter(RateLimitFilter())
+
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+
+        _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=False)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+
+def get_logger(name):
+    """Return a logger, configuring the shared handlers on first use"""
+    if _listener is None:
+        setup_logging()
+    return logging.getLogger(name)
+
+
+def _reinit_after_fork():
+    """The listener thread does not survive fork(): start a fresh one in the child"""
+    global _listener
+    if _listener is not None:
+        _listener = None
+        setup_logging()
+
+
+os.register_at_fork(after_in_child=_reinit_after_fork)
@@ -1,19 +1,29 @@
 # coding: utf-8
 # aprs_send by N1k0droid\\IT9KVB update 14.08.25
 
-import aprslib
-import json
-import configparser
-from datetime import datetime
+import time
+_import_start = time.perf_counter()
+import logging
+import math
 import sys
 import os
-import logging
-import time
-import shutil
+from types import MappingProxyType
+from latest_observation import load_observation
+from aprs_logging import get_logger, setup_logging
+import profiling
+from profiling import stage
+
+log = get_logger("aprs_send")
+# aprslib, configparser and shutil are imported where they are used so the
+# one-shot CLI and the services only pay for what they need
+IMPORT_TIME = time.perf_counter() - _import_start
 
 CONFIG_FILE = "/config/aprs_config.ini"
 DEFAULT_CONFIG_FILE = "/defaults/aprs_config.ini"
 METEO_FILE = "/config/meteo.json"
+# Longest time without a weather transmission when deadbands are configured
+DEFAULT_MAX_SILENCE = 3600
+STATIONS_DIR = "/config/stations.d"
 
 def create_default_config():
     """
@@ -23,14 +33,16 @@ def create_default_config():
     if os.path.exists(CONFIG_FILE):
         return
 
+    import configparser
+    import shutil
     os.makedirs(os.path.dirname(CONFIG_FILE), exist_ok=True)
 
     if os.path.exists(DEFAULT_CONFIG_FILE):
-        print(f"[CONFIG] Copying default config from {DEFAULT_CONFIG_FILE}")
+        log.info("[CONFIG] Copying default config from %s", DEFAULT_CONFIG_FILE)
         shutil.copy(DEFAULT_CONFIG_FILE, CONFIG_FILE)
         return
 
-    print(f"[CONFIG] Creating default config file: {CONFIG_FILE}")
+    log.info("[CONFIG] Creating default config file: %s", CONFIG_FILE)
     config = configparser.ConfigParser()
     config['APRS'] = {
         'callsign': 'NOCALL',
@@ -54,79 +66,168 @@ def create_default_config():
     }
     with open(CONFIG_FILE, 'w') as configfile:
         config.write(configfile)
-    print("[CONFIG] Default configuration created.")
+    log.info("[CONFIG] Default configuration created.")
 
-def read_config():
+def parse_config(config):
     """
-    Load configuration, apply environment variable overrides, and save if modified.
+    Convert a loaded ConfigParser into the settings dictionary used by the sender.
+    Raises configparser.Error, KeyError or ValueError on invalid content.
     """
-    create_default_config()
+    import configparser
+    if 'APRS' not in config:
+        raise configparser.NoSectionError('APRS')
+    if 'Station' not in config:
+        raise configparser.NoSectionError('Station')
 
+    callsign = config['APRS']['callsign'].strip()
+    ssid = config['APRS'].get('ssid', '').strip()
+    passcode = config['APRS']['passcode'].strip()
+    server = config['APRS'].get('server', 'euro.aprs2.net').strip()
+    port = int(config['APRS'].get('port', 14580))
+    comment_prefix = config['APRS'].get('comment_prefix', '').strip()
+    comment = config['APRS'].get('comment', '').strip() or f"73 de {callsign}"
+    comment_wx = config['APRS'].get('comment_wx', '').strip() or "Weather Station"
+    test_message = config['APRS'].get('test_message', '').strip() or "TEST"
+    send_weather = config['APRS'].get('send_weather', 'yes').strip().lower()
+    wx_format = config['APRS'].get('wx_format', 'text').strip().lower()
+    restore_icon = config['APRS'].get('restore_icon', 'no').strip().lower()
+    symbol_table = config['APRS'].get('symbol_table', '/').strip()
+    symbol_code = config['APRS'].get('symbol_code', '<').strip()
+    # Optional per-station schedule and data source (multi-station daemon)
+    interval = config['APRS'].get('interval', '').strip()
+    interval = int(interval) if interval else None
+    meteo_file = config['APRS'].get('meteo_file', '').strip() or METEO_FILE
+    # Change-driven beaconing: "temperature:0.5, pressure:1, wind_direction:10"
+    deadbands = parse_deadbands(config['APRS'].get('deadbands', ''))
+    max_silence = config['APRS'].get('max_silence', '').strip()
+    max_silence = int(max_silence) if max_silence else (DEFAULT_MAX_SILENCE if deadbands else None)
+    lat = float(config['Station']['lat'])
+    lon = float(config['Station']['lon'])
+
+    return {
+        'callsign': callsign, 'ssid': ssid, 'passcode': passcode,
+        'server': server, 'port': port, 'comment_prefix': comment_prefix,
+        'comment': comment, 'comment_wx': comment_wx, 'test_message': test_message,
+        'send_weather': send_weather, 'wx_format': wx_format, 'restore_icon': restore_icon,
+        'symbol_table': symbol_table, 'symbol_code': symbol_code,
+        'interval': interval, 'meteo_file': meteo_file,
+        'deadbands': deadbands, 'max_silence': max_silence,
+        'lat': lat, 'lon': lon
+    }
+
+def parse_deadbands(value):
+    """Parse "field:threshold, ..." into a sorted tuple of (field, float) pairs"""
+    deadbands = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        field, sep, threshold = item.partition(':')
+        if not sep or not field.strip():
+            raise ValueError(f"invalid deadband '{item}', expected field:threshold")
+        deadbands.append((field.strip(), float(threshold)))
+    return tuple(sorted(deadbands))
+
+class ConfigService:
+    """
+    Parsed configuration files shared by the daemon and the sender.
+    Each file is parsed once into an immutable mapping and parsed again only
+    when its mtime, size or inode changes, or after invalidate() (SIGHUP).
+    """
+
+    def __init__(self):
+        self.entries = {}   # path -> (file signature, parsed config)
+
+    def invalidate(self):
+        """Force every file to be parsed again on next use (previous versions stay as fallback)"""
+        self.entries = {path: ('invalidated', cfg) for path, (_, cfg) in self.entries.items()}
+
+    def get(self, path, loader):
+        """Return the cached config for path, calling loader(path) when it changed"""
+        try:
+            st = os.stat(path)
+            signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except OSError:
+            signature = None
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+        try:
+            cfg = MappingProxyType(loader(path))
+        except Exception:
+            if entry is None:
+                raise
+            # Keep running with the last good version until the file is fixed
+            log.error("[CONFIG] %s could not be reloaded, keeping previous configuration", path)
+            self.entries[path] = (signature, entry[1])
+            return entry[1]
+        if entry is not None:
+            log.info("[CONFIG] Reloaded %s", path)
+        self.entries[path] = (signature, cfg)
+        return cfg
+
+config_service = ConfigService()
+
+def apply_env_overrides(config):
+    """Apply APRS_* and STATION_* environment overrides in memory only"""
+    for section, prefix in (('APRS', 'APRS_'), ('Station', 'STATION_')):
+        for key in config[section]:
+            env_key = f"{prefix}{key.upper()}"
+            if env_key in os.environ:
+                config[section][key] = os.environ[env_key]
+                log.info("[CONFIG] Override from ENV: %s=%s", env_key, os.environ[env_key])
+
+def _load_main_config(path):
+    import configparser
     config = configparser.ConfigParser()
-    config.read(CONFIG_FILE)
+    config.read(path)
+    for section in ('APRS', 'Station'):
+        if section not in config:
+            log.error("[CONFIG] Missing section: %s", section)
+            raise configparser.NoSectionError(section)
+    apply_env_overrides(config)
+    try:
+        return parse_config(config)
+    except (configparser.NoOptionError, KeyError, ValueError) as e:
+        log.error("[CONFIG] Configuration file error: %s", e)
+        raise
 
+def read_config():
+    """
+    Return the main configuration with ENV overrides applied, as an immutable
+    mapping. The file is only parsed again when it changes and is never rewritten.
+    """
+    import configparser
+    create_default_config()
     try:
-        if 'APRS' not in config:
-            raise configparser.NoSectionError('APRS')
-        if 'Station' not in config:
-            raise configparser.NoSectionError('Station')
-    except configparser.NoSectionError as e:
-        print(f"[CONFIG] Missing section: {e}")
+        return config_service.get(CONFIG_FILE, _load_main_config)
+    except (configparser.Error, KeyError, ValueError):
         sys.exit(1)
 
-    override_applied = False
-
-    for key in config['APRS']:
-        env_key = f"APRS_{key.upper()}"
-        if env_key in os.environ:
-            config['APRS'][key] = os.environ[env_key]
-            print(f"[CONFIG] Override from ENV: {env_key}={os.environ[env_key]}")
-            override_applied = True
-
-    for key in config['Station']:
-        env_key = f"STATION_{key.upper()}"
-        if env_key in os.environ:
-            config['Station'][key] = os.environ[env_key]
-            print(f"[CONFIG] Override from ENV: {env_key}={os.environ[env_key]}")
-            override_applied = True
-
-    if override_applied:
-        with open(CONFIG_FILE, 'w') as f:
-            config.write(f)
-        print("[CONFIG] Saved updated config with ENV overrides.")
-    else:
-        print("[CONFIG] No ENV overrides detected, using existing config unchanged.")
+def _load_station_profile(path):
+    import configparser
+    config = configparser.ConfigParser()
+    if not config.read(path):
+        raise FileNotFoundError(path)
+    return parse_config(config)
 
-    try:
-        callsign = config['APRS']['callsign'].strip()
-        ssid = config['APRS'].get('ssid', '').strip()
-        passcode = config['APRS']['passcode'].strip()
-        server = config['APRS'].get('server', 'euro.aprs2.net').strip()
-        port = int(config['APRS'].get('port', 14580))
-        comment_prefix = config['APRS'].get('comment_prefix', '').strip()
-        comment = config['APRS'].get('comment', '').strip() or f"73 de {callsign}"
-        comment_wx = config['APRS'].get('comment_wx', '').strip() or "Weather Station"
-        test_message = config['APRS'].get('test_message', '').strip() or "TEST"
-        send_weather = config['APRS'].get('send_weather', 'yes').strip().lower()
-        wx_format = config['APRS'].get('wx_format', 'text').strip().lower()
-        restore_icon = config['APRS'].get('restore_icon', 'no').strip().lower()
-        symbol_table = config['APRS'].get('symbol_table', '/').strip()
-        symbol_code = config['APRS'].get('symbol_code', '<').strip()
-        lat = float(config['Station']['lat'])
-        lon = float(config['Station']['lon'])
-
-        return {
-            'callsign': callsign, 'ssid': ssid, 'passcode': passcode,
-            'server': server, 'port': port, 'comment_prefix': comment_prefix,
-            'comment': comment, 'comment_wx': comment_wx, 'test_message': test_message,
-            'send_weather': send_weather, 'wx_format': wx_format, 'restore_icon': restore_icon,
-            'symbol_table': symbol_table, 'symbol_code': symbol_code,
-            'lat': lat, 'lon': lon
-        }
+def read_station_profile(path):
+    """
+    Load an additional station profile (same format as aprs_config.ini).
+    ENV overrides are not applied: they only target the main configuration.
+    Raises on invalid profiles so the caller can skip them.
+    """
+    return config_service.get(path, _load_station_profile)
 
-    except (configparser.NoOptionError, KeyError, ValueError) as e:
-        print(f"[CONFIG] Configuration file error: {e}")
-        sys.exit(1)
+def list_station_profiles():
+    """Return the sorted list of extra station profiles in STATIONS_DIR"""
+    if not os.path.isdir(STATIONS_DIR):
+        return []
+    return sorted(
+        os.path.join(STATIONS_DIR, name)
+        for name in os.listdir(STATIONS_DIR)
+        if name.endswith('.ini')
+    )
 
 def get_tocall(wx_format, is_test=False):
     return 'APRS' if is_test else 'APTKVB'
@@ -152,7 +253,8 @@ def format_wx_standard(meteo):
     parts.append(f"r{rain_1h:03d}")
     rain_24h = int(round(meteo.get('rain_24h', 0) / 25.4 * 100))
     parts.append(f"p{rain_24h:03d}")
-    parts.append(f"P{rain_24h:03d}")
+    rain_midnight = int(round(meteo['rain_midnight'] / 25.4 * 100)) if 'rain_midnight' in meteo else rain_24h
+    parts.append(f"P{rain_midnight:03d}")
     if 'humidity' in meteo:
         humidity = int(round(meteo['humidity']))
         if humidity == 100:
@@ -163,7 +265,62 @@ def format_wx_standard(meteo):
         parts.append(f"b{pressure:05d}")
     return "".join(parts)
 
-def send_aprs_packet_raw(cfg, packet):
+def base91(value, width):
+    """Fixed-width base-91 digits used by compressed positions"""
+    chars = []
+    for _ in range(width):
+        value, digit = divmod(value, 91)
+        chars.append(chr(33 + digit))
+    return "".join(reversed(chars))
+
+def aprs_compressed_position(lat, lon, symbol_table, symbol_code):
+    """Compressed position (APRS 1.01 ch. 9): table, 4 latitude and 4 longitude digits, symbol"""
+    y = int(round(380926 * (90 - lat)))
+    x = int(round(190463 * (180 + lon)))
+    return f"{symbol_table}{base91(y, 4)}{base91(x, 4)}{symbol_code}"
+
+# Compression type byte: current fix, other source, software origin
+COMPRESSION_TYPE = chr(33 + 0b00100010)
+
+def format_wx_compressed(meteo):
+    """
+    csT bytes carrying wind direction and speed, then only the weather fields
+    present in meteo. Used after a compressed position.
+    """
+    if 'wind_direction' in meteo and 'wind_speed' in meteo:
+        course = int(round((meteo['wind_direction'] % 360) / 4)) % 90
+        knots = meteo['wind_speed'] * 1.94384
+        speed = min(int(round(math.log(knots + 1) / math.log(1.08))), 90)
+        parts = [chr(33 + course), chr(33 + speed), COMPRESSION_TYPE]
+    else:
+        parts = [" ", " ", COMPRESSION_TYPE]
+    if 'wind_gust' in meteo:
+        parts.append(f"g{int(round(meteo['wind_gust'] * 2.237)):03d}")
+    if 'temperature' in meteo:
+        parts.append(f"t{int(round(meteo['temperature'] * 9/5 + 32)):03d}")
+    if 'rain_1h' in meteo:
+        parts.append(f"r{int(round(meteo['rain_1h'] / 25.4 * 100)):03d}")
+    if 'rain_24h' in meteo:
+        parts.append(f"p{int(round(meteo['rain_24h'] / 25.4 * 100)):03d}")
+    if 'rain_midnight' in meteo:
+        parts.append(f"P{int(round(meteo['rain_midnight'] / 25.4 * 100)):03d}")
+    if 'humidity' in meteo:
+        humidity = int(round(meteo['humidity']))
+        parts.append(f"h{0 if humidity == 100 else humidity:02d}")
+    if 'pressure' in meteo:
+        parts.append(f"b{int(round(meteo['pressure'] * 10)):05d}")
+    return "".join(parts)
+
+def send_aprs_packet_raw(cfg, packet, session=None):
+    if session is not None:
+        try:
+            session.send(packet)
+            log.info("APRS packet sent: %s", packet)
+            return True
+        except Exception as e:
+            log.error("APRS-IS error: %s", e)
+            return False
+
     callsign_full = cfg['callsign']
     if cfg['ssid']:
         try:
@@ -172,123 +329,314 @@ def send_aprs_packet_raw(cfg, packet):
                 callsign_full = f"{cfg['callsign']}-{n}"
         except ValueError:
             pass
+    import aprslib
     try:
         ais = aprslib.IS(callsign_full, cfg['passcode'], host=cfg['server'], port=cfg['port'])
-        ais.connect()
-        ais.sendall(packet)
+        with stage('connect'):
+            ais.connect()
+        with stage('send'):
+            ais.sendall(packet)
         ais.close()
-        print("APRS packet sent:", packet)
+        log.info("APRS packet sent: %s", packet)
         return True
     except Exception as e:
-        print("APRS-IS error:", e)
+        log.error("APRS-IS error: %s", e)
         return False
 
-def send_aprs_packet(cfg, meteo, is_test=False):
-    callsign = cfg['callsign']
-    ssid = cfg['ssid']
-    comment_prefix = cfg['comment_prefix']
-    comment = cfg['comment']
-    comment_wx = cfg['comment_wx']
-    test_message = cfg['test_message']
-    send_weather = cfg['send_weather']
-    wx_format = cfg['wx_format']
-    restore_icon = cfg['restore_icon']
-    symbol_table = cfg['symbol_table']
-    symbol_code = cfg['symbol_code']
-    lat = cfg['lat']
-    lon = cfg['lon']
-
-    callsign_full = callsign
-    if ssid:
-        try:
-            n = int(ssid)
-            if 0 <= n <= 15:
-                callsign_full = f"{callsign}-{n}"
-            else:
-                print(f"SSID {ssid} out of range, ignored.")
-        except ValueError:
-            print(f"SSID '{ssid}' invalid, ignored.")
+# Weather formats besides 'text'
+WX_FORMATS = ('wx', 'wx-text', 'wx-compressed')
 
-    tocall = get_tocall(wx_format, is_test)
-    now = datetime.utcnow().strftime("%d%H%M")
-    lat_aprs = aprs_coord(lat, True)
-    lon_aprs = aprs_coord(lon, False)
+class PacketEncoder:
+    """
+    Packet builder precompiled from a read_config() dictionary.
+    Callsign, TOCALL, coordinates, header and mode are derived once;
+    each packet only formats the timestamp and the weather fields.
+    """
 
-    if is_test:
-        msg = f"{comment_prefix} {test_message}" if comment_prefix else test_message
-        packet = f"{callsign_full}>{tocall},TCPIP*:@{now}z{lat_aprs}{symbol_table}{lon_aprs}{symbol_code} {msg}"
-        print(f"TEST mode active (TOCALL: {tocall})")
-        send_aprs_packet_raw(cfg, packet)
-        return
+    def __init__(self, cfg):
+        callsign = cfg['callsign']
+        ssid = cfg['ssid']
+        callsign_full = callsign
+        if ssid:
+            try:
+                n = int(ssid)
+                if 0 <= n <= 15:
+                    callsign_full = f"{callsign}-{n}"
+                else:
+                    log.warning("SSID %s out of range, ignored.", ssid)
+            except ValueError:
+                log.warning("SSID '%s' invalid, ignored.", ssid)
 
-    if send_weather == 'yes' and wx_format == 'wx-text' and meteo:
-        print(f"WX-TEXT mode active (TOCALL: {tocall})")
-        comment_packet = f"{callsign_full}>{tocall},TCPIP*:@{now}z{lat_aprs}{symbol_table}{lon_aprs}{symbol_code} {comment_wx}"
-        if send_aprs_packet_raw(cfg, comment_packet):
-            print("Comment sent, waiting 15 seconds...")
-            time.sleep(15)
-            now = datetime.utcnow().strftime("%d%H%M")
-            lat_aprs = aprs_coord(lat, True)
-            lon_aprs = aprs_coord(lon, False)
-            wx_data = format_wx_standard(meteo)
-            wx_packet = f"{callsign_full}>{tocall},TCPIP*:@{now}z{lat_aprs}/{lon_aprs}_{wx_data}"
-            print("Sending WX data...")
-            if send_aprs_packet_raw(cfg, wx_packet) and restore_icon == 'yes':
-                print("WX data sent, restoring icon...")
-                time.sleep(15)
-                now = datetime.utcnow().strftime("%d%H%M")
-                restore_packet = f"{callsign_full}>{tocall},TCPIP*:@{now}z{lat_aprs}{symbol_table}{lon_aprs}{symbol_code}"
-                send_aprs_packet_raw(cfg, restore_packet)
-        return
+        self.callsign_full = callsign_full
+        self.tocall = get_tocall(cfg['wx_format'], False)
+        self.test_tocall = get_tocall(cfg['wx_format'], True)
+        self.header = f"{callsign_full}>{self.tocall},TCPIP*:@"
+        self.test_header = f"{callsign_full}>{self.test_tocall},TCPIP*:@"
 
-    if send_weather == 'yes' and wx_format == 'wx' and meteo:
-        now = datetime.utcnow().strftime("%d%H%M")
-        lat_aprs = aprs_coord(lat, True)
-        lon_aprs = aprs_coord(lon, False)
-        wx_data = format_wx_standard(meteo)
-        packet = f"{callsign_full}>{tocall},TCPIP*:@{now}z{lat_aprs}/{lon_aprs}_{wx_data}"
-        print(f"WX station mode active (TOCALL: {tocall})")
-        send_aprs_packet_raw(cfg, packet)
-        return
+        lat_aprs = aprs_coord(cfg['lat'], True)
+        lon_aprs = aprs_coord(cfg['lon'], False)
+        # Position with the configured symbol, and with the weather station symbol
+        self.position = f"{lat_aprs}{cfg['symbol_table']}{lon_aprs}{cfg['symbol_code']}"
+        self.wx_position = f"{lat_aprs}/{lon_aprs}_"
+        self.wx_compressed_position = aprs_compressed_position(cfg['lat'], cfg['lon'], '/', '_')
 
+        comment_prefix = cfg['comment_prefix']
+        test_message = cfg['test_message']
+        self.test_message = f"{comment_prefix} {test_message}" if comment_prefix else test_message
+        self.comment_prefix = comment_prefix
+        self.comment = cfg['comment']
+        self.comment_wx = cfg['comment_wx']
+        self.restore_icon = cfg['restore_icon'] == 'yes'
+
+        # 'wx' and 'wx-text' only apply when weather sending is enabled
+        self.send_weather = cfg['send_weather'] == 'yes'
+        self.mode = cfg['wx_format'] if self.send_weather and cfg['wx_format'] in WX_FORMATS else 'text'
+
+        # Change-driven beaconing: weather is only sent when a field moved past its deadband
+        self.deadbands = dict(cfg.get('deadbands') or ())
+        self.max_silence = cfg.get('max_silence')
+
+        self._minute = None
+        self._stamp = None
+
+    def timestamp(self):
+        """DDHHMM zulu timestamp, formatted once per minute"""
+        now = time.time()
+        minute = int(now // 60)
+        if minute != self._minute:
+            self._minute = minute
+            self._stamp = time.strftime("%d%H%M", time.gmtime(now))
+        return self._stamp
+
+    def should_send(self, meteo, state, now=None):
+        """
+        True when meteo differs from the values last sent by this station
+        (a BeaconState) by more than a deadband (fields without one: any
+        change), when the field set changed or when max_silence seconds
+        passed. Always True without deadbands.
+        """
+        if not self.deadbands or not self.send_weather or not meteo:
+            return True
+        last = state.last_values
+        now = time.time() if now is None else now
+        if last is None or (self.max_silence and now - state.last_sent >= self.max_silence):
+            return True
+        if meteo.keys() != last.keys():
+            return True
+        deadbands = self.deadbands
+        for key, value in meteo.items():
+            previous = last[key]
+            try:
+                delta = abs(value - previous)
+            except TypeError:
+                if value != previous:
+                    return True
+                continue
+            if key == 'wind_direction':
+                delta = min(delta, 360 - delta)
+            if delta > deadbands.get(key, 0.0):
+                return True
+        return False
+
+    def mark_sent(self, meteo, state, now=None):
+        """Remember the values just transmitted in state for the next should_send()"""
+        if not self.deadbands:
+            return
+        state.last_values = dict(meteo)
+        state.last_sent = time.time() if now is None else now
+
+    def test_packet(self):
+        return f"{self.test_header}{self.timestamp()}z{self.position} {self.test_message}"
+
+    def position_packet(self, message=None):
+        """Position with the configured symbol, optionally followed by a comment"""
+        if message is None:
+            return f"{self.header}{self.timestamp()}z{self.position}"
+        return f"{self.header}{self.timestamp()}z{self.position} {message}"
+
+    def wx_packet(self, meteo):
+        if self.mode == 'wx-compressed':
+            return f"{self.header}{self.timestamp()}z{self.wx_compressed_position}{format_wx_compressed(meteo)}"
+        return f"{self.header}{self.timestamp()}z{self.wx_position}{format_wx_standard(meteo)}"
+
+    def text_packet(self, meteo):
+        parts = format_text_weather(meteo) if self.send_weather and meteo else []
+        msg = " ".join(parts) if parts else self.comment
+        if self.comment_prefix:
+            msg = f"{self.comment_prefix} {msg}"
+        return self.position_packet(msg)
+
+TEXT_KNOWN_FIELDS = {'temperature','dewpoint','humidity','pressure',
+                     'wind_speed','wind_direction','wind_gust','rain_1h','rain_24h','rain_midnight'}
+
+def format_text_weather(meteo):
+    """Human readable weather parts for text mode"""
     parts = []
-    if send_weather == 'yes':
-        if meteo:
-            if 'temperature' in meteo: parts.append(f"Temp: {meteo['temperature']:.1f}C")
-            if 'dewpoint' in meteo: parts.append(f"DewPt: {meteo['dewpoint']:.1f}C")
-            if 'humidity' in meteo: parts.append(f"Hum: {int(round(meteo['humidity']))}%")
-            if 'pressure' in meteo: parts.append(f"Press: {meteo['pressure']:.1f}hPa")
-            if 'wind_speed' in meteo: parts.append(f"WindSpd: {meteo['wind_speed']:.1f}m/s")
-            if 'wind_direction' in meteo: parts.append(f"WindDir: {meteo['wind_direction']}")
-            if 'wind_gust' in meteo: parts.append(f"WindGust: {meteo['wind_gust']:.1f}m/s")
-            if 'rain_1h' in meteo: parts.append(f"Rain1h: {meteo['rain_1h']:.1f}mm")
-            if 'rain_24h' in meteo: parts.append(f"Rain24h: {meteo['rain_24h']:.1f}mm")
-            known = {'temperature','dewpoint','humidity','pressure',
-                     'wind_speed','wind_direction','wind_gust','rain_1h','rain_24h'}
-            for k, v in meteo.items():
-                if k not in known and isinstance(v, (int, float)):
-                    parts.append(f"{k.title()}: {v:.1f}" if isinstance(v, float) else f"{k.title()}: {v}")
-    msg = " ".join(parts) if parts else comment
-    if comment_prefix:
-        msg = f"{comment_prefix} {msg}"
-    packet = f"{callsign_full}>{tocall},TCPIP*:@{now}z{lat_aprs}{symbol_table}{lon_aprs}{symbol_code} {msg}"
-    send_aprs_packet_raw(cfg, packet)
+    if 'temperature' in meteo: parts.append(f"Temp: {meteo['temperature']:.1f}C")
+    if 'dewpoint' in meteo: parts.append(f"DewPt: {meteo['dewpoint']:.1f}C")
+    if 'humidity' in meteo: parts.append(f"Hum: {int(round(meteo['humidity']))}%")
+    if 'pressure' in meteo: parts.append(f"Press: {meteo['pressure']:.1f}hPa")
+    if 'wind_speed' in meteo: parts.append(f"WindSpd: {meteo['wind_speed']:.1f}m/s")
+    if 'wind_direction' in meteo: parts.append(f"WindDir: {meteo['wind_direction']}")
+    if 'wind_gust' in meteo: parts.append(f"WindGust: {meteo['wind_gust']:.1f}m/s")
+    if 'rain_1h' in meteo: parts.append(f"Rain1h: {meteo['rain_1h']:.1f}mm")
+    if 'rain_24h' in meteo: parts.append(f"Rain24h: {meteo['rain_24h']:.1f}mm")
+    if 'rain_midnight' in meteo: parts.append(f"RainMidnight: {meteo['rain_midnight']:.1f}mm")
+    for k, v in meteo.items():
+        if k not in TEXT_KNOWN_FIELDS and isinstance(v, (int, float)):
+            parts.append(f"{k.title()}: {v:.1f}" if isinstance(v, float) else f"{k.title()}: {v}")
+    return parts
+
+_encoders = {}
+ENCODER_CACHE_SIZE = 1024
+
+def get_encoder(cfg):
+    """
+    Return the cached PacketEncoder for this configuration.
+    Configurations are looked up by identity, without hashing their items,
+    and are treated as immutable: ConfigService returns a new read-only
+    mapping whenever a file changes.
+    """
+    entry = _encoders.get(id(cfg))
+    if entry is not None and entry[0] is cfg:
+        return entry[1]
+    if len(_encoders) >= ENCODER_CACHE_SIZE:
+        _encoders.clear()
+    encoder = PacketEncoder(cfg)
+    # Keeping cfg in the entry keeps its id() from being reused
+    _encoders[id(cfg)] = (cfg, encoder)
+    return encoder
+
+class BeaconState:
+    """Weather last transmitted by one station, compared against its deadbands"""
+
+    def __init__(self):
+        self.last_values = None
+        self.last_sent = 0.0
+
+# Kept per full callsign, apart from the encoder cache, so that configuration
+# reloads and cache evictions do not make every station beacon again
+_beacon_states = {}
+
+def get_beacon_state(callsign):
+    state = _beacon_states.get(callsign)
+    if state is None:
+        state = _beacon_states[callsign] = BeaconState()
+    return state
+
+# Pause between the packets of a wx-text sequence
+WX_TEXT_DELAY = 15
+
+def send_aprs_packet(cfg, meteo, is_test=False, session=None, outbox=None):
+    """
+    Build and send the packet(s) for one transmission.
+    With an outbox, failed packets are queued for retry and the wx-text
+    delays become scheduled entries instead of blocking sleeps.
+    Returns False when the weather did not change past the configured deadbands.
+    The values only count as sent for the deadbands once the weather packet
+    was written or durably queued.
+    """
+    encoder = get_encoder(cfg)
+    deliver = lambda packet: send_aprs_packet_raw(cfg, packet, session)
+    if outbox is None:
+        send = deliver
+    else:
+        def send(packet):
+            # Queued packets are kept on disk and retried until sent
+            outbox.submit(packet, deliver)
+            return True
+
+    if is_test:
+        log.info("TEST mode active (TOCALL: %s)", encoder.test_tocall)
+        send(encoder.test_packet())
+        return True
+
+    state = get_beacon_state(encoder.callsign_full)
+    if not encoder.should_send(meteo, state):
+        log.info("Weather unchanged within deadbands, transmission skipped")
+        return False
+
+    if encoder.mode == 'wx-text' and meteo:
+        log.info("WX-TEXT mode active (TOCALL: %s)", encoder.tocall)
+        if outbox is not None:
+            # Each packet follows the previous one by WX_TEXT_DELAY seconds once it is sent
+            previous = outbox.submit(encoder.position_packet(encoder.comment_wx), deliver)
+            previous = outbox.submit(encoder.wx_packet(meteo), deliver, delay=WX_TEXT_DELAY, after=previous)
+            if encoder.restore_icon:
+                outbox.submit(encoder.position_packet(), deliver, delay=WX_TEXT_DELAY, after=previous)
+            encoder.mark_sent(meteo, state)
+            log.info("WX data scheduled %s seconds after the comment", WX_TEXT_DELAY)
+            return True
+        if send_aprs_packet_raw(cfg, encoder.position_packet(encoder.comment_wx), session):
+            log.info("Comment sent, waiting 15 seconds...")
+            time.sleep(WX_TEXT_DELAY)
+            log.info("Sending WX data...")
+            if send_aprs_packet_raw(cfg, encoder.wx_packet(meteo), session):
+                encoder.mark_sent(meteo, state)
+                if encoder.restore_icon:
+                    log.info("WX data sent, restoring icon...")
+                    time.sleep(WX_TEXT_DELAY)
+                    send_aprs_packet_raw(cfg, encoder.position_packet(), session)
+        return True
+
+    if encoder.mode in ('wx', 'wx-compressed') and meteo:
+        log.info("WX station mode active (TOCALL: %s%s)", encoder.tocall,
+                 ", compressed" if encoder.mode == 'wx-compressed' else "")
+        with stage('encode'):
+            packet = encoder.wx_packet(meteo)
+        if send(packet):
+            encoder.mark_sent(meteo, state)
+        return True
+
+    with stage('encode'):
+        packet = encoder.text_packet(meteo)
+    if send(packet):
+        encoder.mark_sent(meteo, state)
+    return True
 
 def main():
-    cfg = read_config()
     is_test = '--test' in sys.argv
     debug = '--debug' in sys.argv
-    logging.basicConfig(level=logging.DEBUG if debug else logging.INFO)
+    startup_profile = '--startup-profile' in sys.argv
+    stages = [('imports', IMPORT_TIME)]
+    started = time.perf_counter()
+
+    cfg = read_config()
+    stages.append(('config', time.perf_counter() - started))
+    setup_logging(debug)
     if debug:
-        print("DEBUG mode active")
-    if os.path.exists(METEO_FILE):
-        with open(METEO_FILE) as f:
-            meteo = json.load(f)
-        print(f"Weather file loaded: {len(meteo)} parameters")
+        log.debug("DEBUG mode active")
+
+    mark = time.perf_counter()
+    meteo = load_observation(METEO_FILE)
+    # Rain totals and gust from the receiver's shared history
+    from observation_history import ObservationHistory
+    from wx_aggregates import WeatherAggregator
+    aggregator = WeatherAggregator()
+    aggregator.update(ObservationHistory())
+    meteo = aggregator.apply(meteo)
+    stages.append(('observation', time.perf_counter() - mark))
+    if meteo:
+        log.info("Weather data loaded: %d parameters", len(meteo))
     else:
-        meteo = {}
-        print("Weather file not found - using empty data")
+        log.info("Weather data not found - using empty data")
+
+    mark = time.perf_counter()
+    profiling.begin('aprs_send', logging.INFO)
     send_aprs_packet(cfg, meteo, is_test=is_test)
+    profiling.end()
+    stages.append(('send', time.perf_counter() - mark))
+
+    if startup_profile:
+        # Stage times include modules imported lazily during that stage
+        total = IMPORT_TIME + time.perf_counter() - started
+        log.info("Startup profile: %s, total %.1f ms",
+                 ", ".join(f"{name} {seconds * 1000:.1f} ms" for name, seconds in stages), total * 1000)
 
 if __name__ == "__main__":
-    main()
+    if '--profile' in sys.argv:
+        # cProfile of the whole run plus encode/connect/send stage timings
+        profiling.STAGES_ENABLED = True
+        profiling.profile_call("aprs_send", main)
+    else:
+        main()
@@ -5,153 +5,476 @@ import os
 import signal
 import sys
 import json
+import heapq
 import logging
+import itertools
+import select
+import socket
 
 # Import functions from aprs_send.py
 sys.path.append('/app')
-from aprs_send import send_aprs_packet, read_config
+from aprs_send import (send_aprs_packet, send_aprs_packet_raw, read_config, read_station_profile,
+                       list_station_profiles, config_service, METEO_FILE)
+from latest_observation import read_latest_observation, ObservationListener
+from observation_history import ObservationHistory
+from wx_aggregates import WeatherAggregator
+from aprs_logging import get_logger, setup_logging
+from metrics import registry
+
+log = get_logger("aprs_send_daemon")
+from aprs_session import APRSSession, APRSFeed, feed_filter, full_callsign
+from outbox import Outbox
+import profiling
+from delivery import DeliveryTracker
+
+TRANSMISSIONS = registry.counter('aprs_transmissions_total', "Beacon transmissions by station and result",
+                                 ('station', 'result'))
+TRANSMIT_SECONDS = registry.histogram('aprs_transmission_seconds',
+                                      "Time to load config and data, encode and send one beacon")
+
+MAIN_STATION = "main"
+ENV_CHECK_INTERVAL = 60
+
+def aligned_due(now, interval, offset=0.0):
+    """Next time after now on the wall-clock grid offset + k * interval"""
+    return ((now - offset) // interval + 1) * interval + offset
+
+class BeaconScheduler:
+    """
+    Min-heap of (due time, station) entries driving all beacon transmissions.
+    Rescheduling a station just pushes a new entry; older entries for it are
+    recognised as stale (station['due'] differs) and skipped.
+    """
 
-class APRSDaemon:
     def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, due, station):
+        # The counter keeps ordering stable for stations due at the same time
+        station['due'] = due
+        heapq.heappush(self.heap, (due, next(self.counter), station))
+
+    def _drop_stale(self):
+        while self.heap and self.heap[0][2].get('due') != self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+    def next_due(self):
+        self._drop_stale()
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        """Remove and return every (due, station) entry scheduled at or before now"""
+        due = []
+        self._drop_stale()
+        while self.heap and self.heap[0][0] <= now:
+            entry_due, _, station = heapq.heappop(self.heap)
+            station['due'] = None
+            due.append((entry_due, station))
+            self._drop_stale()
+        return due
+
+class APRSDaemon:
+    def __init__(self, started_at=None):
         self.running = True
+        # Service start time; when set the delay to the first packet is logged
+        self.started_at = started_at
+        self.session = None
+        self.primary_cfg = None
+        self.stations = []
+        self.scheduler = BeaconScheduler()
+        self.listener = None
+        self.outbox = None
+        # Delivery verification (APRS_VERIFY_DELIVERY=on): receive-only feed of our own packets
+        self.feed = None
+        self.delivery = None
+        # Timestamp of the observation being transmitted, None for queued packets
+        self.meteo_timestamp = None
+        # Rain totals and gust from the samples every receiver process stores in the shared history
+        self.history = ObservationHistory()
+        self.aggregator = WeatherAggregator()
+        # Self-pipe so a shutdown signal interrupts the wait immediately
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_w.setblocking(False)
         # Signal handlers for clean shutdown
         signal.signal(signal.SIGTERM, self.signal_handler)
         signal.signal(signal.SIGINT, self.signal_handler)
-        
-        print("APRS Daemon initialized")
-    
+        # SIGHUP re-reads every configuration file on the next transmission
+        signal.signal(signal.SIGHUP, self.reload_handler)
+
+        log.info("APRS Daemon initialized")
+
     def signal_handler(self, signum, frame):
-        print(f"Received shutdown signal {signum}")
+        log.info("Received shutdown signal %s", signum)
         self.running = False
-    
+        try:
+            self.wakeup_w.send(b'x')
+        except OSError:
+            pass
+
+    def reload_handler(self, signum, frame):
+        log.info("Received SIGHUP, configuration will be reloaded")
+        config_service.invalidate()
+
+    def get_session(self):
+        """
+        Return the APRS-IS session shared by all stations.
+        It logs in with the main station credentials and is recreated if they change.
+        """
+        cfg = self.primary_cfg
+        if self.session is not None and not self.session.matches(cfg):
+            log.info("APRS-IS settings changed, reopening session")
+            self.session.close()
+            self.session = None
+        if self.session is None:
+            self.session = APRSSession.from_config(cfg)
+            if self.delivery is not None:
+                self.session.on_sent = lambda packet: self.delivery.sent(packet, self.meteo_timestamp)
+        return self.session
+
+    def load_stations(self):
+        """
+        Build the station list: the main aprs_config.ini plus every valid
+        profile found in the stations directory.
+        """
+        stations = [{'name': MAIN_STATION, 'path': None, 'count': 0, 'last_sent': 0.0,
+                     'interval': self.primary_cfg['interval'],
+                     'meteo_file': self.primary_cfg['meteo_file']}]
+        for path in list_station_profiles():
+            try:
+                cfg = read_station_profile(path)
+            except Exception as e:
+                log.warning("Station profile %s skipped: %s", path, e)
+                continue
+            stations.append({'name': os.path.basename(path), 'path': path, 'count': 0, 'last_sent': 0.0,
+                             'interval': cfg['interval'], 'meteo_file': cfg['meteo_file']})
+            log.info("Station profile loaded: %s (%s-%s)", path, cfg['callsign'], cfg['ssid'])
+        return stations
+
+    def load_station_config(self, station):
+        """Read the current configuration of a station"""
+        if station['path'] is None:
+            cfg = read_config()
+            self.primary_cfg = cfg
+            return cfg
+        return read_station_profile(station['path'])
+
     def initialize_system(self):
         """Initialize system on first startup"""
-        print("Initializing APRS Weather Station...")
-        
+        log.info("Initializing APRS Weather Station...")
+
         try:
             # Check / create configuration
             cfg = read_config()
-            print(f"Configuration ready for {cfg['callsign']}-{cfg['ssid']}")
-            
+            self.primary_cfg = cfg
+            log.info("Configuration ready for %s-%s", cfg['callsign'], cfg['ssid'])
+
             # Check for weather data file (optional)
-            meteo_file = "/config/meteo.json"
+            meteo_file = cfg['meteo_file']
             if os.path.exists(meteo_file):
-                print("Weather data file found")
+                log.info("Weather data file found")
             else:
-                print("Weather data file not found (will be created when data arrives)")
-            
-            print("System initialization completed successfully")
-            
+                log.info("Weather data file not found (will be created when data arrives)")
+
+            self.stations = self.load_stations()
+            log.info("%s station(s) configured", len(self.stations))
+
+            # Packets queued by a previous run are restored from disk
+            self.outbox = Outbox()
+
+            log.info("System initialization completed successfully")
+
         except Exception as e:
-            print(f"System initialization failed: {e}")
+            log.error("System initialization failed: %s", e)
             raise
-    
+
+    def load_meteo(self, meteo_file):
+        """
+        Load weather data for one station, returning {} if unavailable.
+        Receiver data gets its rain totals and gust evaluated now.
+        """
+        meteo = self.read_meteo(meteo_file)
+        if meteo_file == METEO_FILE:
+            self.consume_history()
+            meteo = self.aggregator.apply(meteo)
+        return meteo
+
+    def consume_history(self):
+        """Feed the samples stored since the last wakeup to the aggregator"""
+        try:
+            self.aggregator.update(self.history)
+        except OSError as e:
+            log.warning("Observation history unavailable: %s", e)
+
+    def read_meteo(self, meteo_file):
+        if meteo_file == METEO_FILE:
+            # The receiver publishes the latest observation in shared memory
+            current = read_latest_observation()
+            if current is not None:
+                meteo, self.meteo_timestamp = current
+                log.info("Latest observation loaded: %s parameters", len(meteo))
+                log.debug("Weather data: %s", meteo)
+                return meteo
+        if not os.path.exists(meteo_file):
+            log.info("Weather file not found - using empty data")
+            return {}
+        try:
+            with open(meteo_file, 'r') as f:
+                meteo = json.load(f)
+            self.meteo_timestamp = os.path.getmtime(meteo_file)
+            log.info("Weather file loaded: %s parameters", len(meteo))
+            log.debug("Weather data: %s", meteo)
+            return meteo
+        except json.JSONDecodeError as e:
+            log.error("Error parsing weather file: %s", e)
+        except Exception as e:
+            log.error("Error reading weather file: %s", e)
+        return {}
+
+    def transmit(self, station):
+        """Send one beacon for a station; False if skipped because the weather did not change"""
+        log.info("--- Station %s: transmission #%s ---", station['name'], station['count'] + 1)
+        # Opt-in (APRS_PROFILE=on) timings of read_config, load, encode, connect and send
+        profiling.begin('transmit', logging.INFO)
+
+        try:
+            # Cached configuration (ENV overrides applied for the main station), re-parsed only if changed
+            with profiling.stage('read_config'):
+                cfg = self.load_station_config(station)
+            station['interval'] = cfg['interval']
+            station['meteo_file'] = cfg['meteo_file']
+            log.info("Config loaded for %s-%s", cfg['callsign'], cfg['ssid'])
+
+            with profiling.stage('load'):
+                meteo = self.load_meteo(cfg['meteo_file'])
+
+            # Send APRS packet over the shared session; failed and delayed packets go to the outbox
+            sent = send_aprs_packet(cfg, meteo, is_test=False, session=self.get_session(), outbox=self.outbox)
+        finally:
+            self.meteo_timestamp = None
+            profiling.end()
+        if not sent:
+            log.info("Station %s: nothing new to send", station['name'])
+            return False
+        station['last_sent'] = time.time()
+        station['count'] += 1
+        if self.started_at is not None:
+            log.info("Startup profile: first packet %.1f ms after service start",
+                     (station['last_sent'] - self.started_at) * 1000)
+            self.started_at = None
+        log.info("Station %s: transmission #%s completed successfully", station['name'], station['count'])
+        return True
+
+    def schedule_initial(self, default_interval):
+        """
+        Queue the first transmission of every station, spreading them evenly
+        over their interval so packets do not burst together.
+        """
+        now = time.time()
+        total = len(self.stations)
+        for index, station in enumerate(self.stations):
+            interval = station.get('interval') or default_interval
+            # Later transmissions stay on the wall-clock grid shifted by this offset
+            station['offset'] = interval * index / total
+            self.scheduler.add(now + station['offset'], station)
+
+    def send_queued(self, packet):
+        """Send a packet from the outbox over the shared session"""
+        return send_aprs_packet_raw(self.primary_cfg, packet, self.get_session())
+
+    def open_listener(self):
+        """Listen for new-observation notifications from the receiver"""
+        try:
+            self.listener = ObservationListener()
+            log.info("Listening for new observations on %s", self.listener.path)
+        except OSError as e:
+            log.warning("New-observation notifications unavailable (%s), using timers only", e)
+            self.listener = None
+
+    def on_new_observation(self, min_interval):
+        """
+        Pull forward stations fed by the receiver so fresh data goes out now,
+        while keeping at least min_interval seconds between their packets.
+        """
+        now = time.time()
+        for station in self.stations:
+            if station['meteo_file'] != METEO_FILE:
+                continue
+            due = max(now, station['last_sent'] + min_interval)
+            if station['due'] is None or due < station['due']:
+                self.scheduler.add(due, station)
+
+    def open_feed(self):
+        """
+        Start delivery verification: a receive-only APRS-IS login filtered on
+        our callsigns, preferably on another server than the sending session.
+        """
+        cfg = self.primary_cfg
+        callsigns = [full_callsign(cfg)]
+        for station in self.stations[1:]:
+            try:
+                callsigns.append(full_callsign(self.load_station_config(station)))
+            except Exception as e:
+                log.warning("Station %s left out of delivery verification: %s", station['name'], e)
+        login = os.getenv('APRS_DELIVERY_LOGIN') or f"{cfg['callsign']}-RX"[:9]
+        session = self.get_session()
+        self.delivery = DeliveryTracker()
+        session.on_sent = lambda packet: self.delivery.sent(packet, self.meteo_timestamp)
+        self.feed = APRSFeed(login, session.servers, feed_filter(callsigns))
+        self.feed.connect(prefer_index=(session.server_index + 1) % len(session.servers))
+        log.info("Delivery verification enabled (%s)", self.feed.filter_text)
+
+    def on_feed_data(self):
+        """Match packets echoed by the feed against the ones we sent"""
+        for line in self.feed.read_lines():
+            self.delivery.received(line)
+
+    def wait(self, timeout):
+        """Block until the timeout, a new observation, feed data or a shutdown signal.
+        Returns the readable sources."""
+        sources = [self.wakeup_r]
+        if self.listener is not None:
+            sources.append(self.listener)
+        if self.feed is not None and self.feed.connected:
+            sources.append(self.feed)
+        readable, _, _ = select.select(sources, [], [], max(0.0, timeout))
+        if self.wakeup_r in readable:
+            self.wakeup_r.recv(64)
+        return readable
+
     def run(self):
         # Initialize system on first run
         self.initialize_system()
-        
+
         # Read runtime settings from environment variables with defaults
         enabled = os.getenv('APRS_AUTO_ENABLED', 'off').lower()
         interval = int(os.getenv('APRS_UPDATE_INTERVAL', '3600'))
         debug = os.getenv('APRS_DEBUG', 'yes').lower() == 'yes'
-        
+        # Opt-in: send as soon as new data arrives, at most once every APRS_MIN_INTERVAL seconds
+        event_driven = os.getenv('APRS_SEND_ON_DATA', 'off').lower() == 'on'
+        min_interval = int(os.getenv('APRS_MIN_INTERVAL', '300'))
+
+        setup_logging(debug)
         if debug:
-            logging.basicConfig(level=logging.DEBUG)
-            print("DEBUG mode enabled via environment variable")
-        else:
-            logging.basicConfig(level=logging.INFO)
-        
-        print(f"APRS Daemon starting:")
-        print(f"  - Enabled: {enabled}")
-        print(f"  - Update interval: {interval} seconds")
-        print(f"  - Debug: {debug}")
-        
-        transmission_count = 0
-        
+            log.debug("DEBUG mode enabled via environment variable")
+
+        log.info("APRS Daemon starting:")
+        log.info("  - Enabled: %s", enabled)
+        log.info("  - Stations: %s", len(self.stations))
+        log.info("  - Update interval: %s seconds (default)", interval)
+        log.info("  - Send on new data: %s (minimum interval %s seconds)", event_driven, min_interval)
+        log.info("  - Debug: %s", debug)
+
+        self.schedule_initial(interval)
+        if event_driven:
+            self.open_listener()
+        if os.getenv('APRS_VERIFY_DELIVERY', 'off').lower() == 'on':
+            self.open_feed()
+
+        if enabled != 'on':
+            log.info("Daemon disabled via APRS_AUTO_ENABLED=off")
+            log.info("Set APRS_AUTO_ENABLED=on to enable automatic transmissions")
+
+        next_env_check = time.time() + ENV_CHECK_INTERVAL
+
         while self.running:
-            if enabled == 'on':
-                try:
-                    print(f"\n--- Transmission #{transmission_count + 1} ---")
-                    
-                    # Load configuration (also applies ENV overrides)
-                    cfg = read_config()
-                    print(f"Config loaded for {cfg['callsign']}-{cfg['ssid']}")
-                    
-                    # Load weather data
-                    meteo_file = "/config/meteo.json"
-                    if os.path.exists(meteo_file):
-                        try:
-                            with open(meteo_file, 'r') as f:
-                                meteo = json.load(f)
-                            print(f"Weather file loaded: {len(meteo)} parameters")
-                            if debug:
-                                print(f"Weather data: {meteo}")
-                        except json.JSONDecodeError as e:
-                            print(f"Error parsing weather file: {e}")
-                            meteo = {}
-                        except Exception as e:
-                            print(f"Error reading weather file: {e}")
-                            meteo = {}
+            now = time.time()
+
+            for due, station in self.scheduler.pop_due(now):
+                if enabled == 'on':
+                    started = time.perf_counter()
+                    try:
+                        sent = self.transmit(station)
+                        TRANSMISSIONS.inc(station['name'], 'ok' if sent else 'skipped')
+                    except Exception as e:
+                        TRANSMISSIONS.inc(station['name'], 'error')
+                        log.error("Error in transmission for station %s: %s", station['name'], e,
+                                  exc_info=debug)
+                    TRANSMIT_SECONDS.observe(time.perf_counter() - started)
+
+                # Next regular slot on the station's wall-clock grid, never sooner than min_interval
+                station_interval = station.get('interval') or interval
+                next_due = max(aligned_due(time.time(), station_interval, station['offset']),
+                               station['last_sent'] + min_interval)
+                self.scheduler.add(next_due, station)
+                if enabled == 'on':
+                    log.info("Station %s: next transmission in %.0f seconds", station['name'], next_due - time.time())
+
+            # Queued retries and delayed packets (wx-text sequences)
+            if enabled == 'on' and len(self.outbox):
+                self.outbox.run_due(self.send_queued)
+
+            # Sleep until the next timer, keepalive or ENV check; new data and signals wake earlier
+            wake = min(self.scheduler.next_due(), next_env_check)
+            outbox_due = self.outbox.next_due() if enabled == 'on' else None
+            if outbox_due is not None:
+                wake = min(wake, outbox_due)
+            if self.session is not None and self.session.connected:
+                wake = min(wake, self.session.last_activity + self.session.keepalive_interval)
+            if self.feed is not None:
+                wake = min(wake, self.feed.next_wakeup())
+                expiry = self.delivery.next_expiry()
+                if expiry is not None:
+                    wake = min(wake, expiry)
+            readable = self.wait(wake - time.time())
+            # At least every ENV_CHECK_INTERVAL, so the cursor never falls a capacity behind
+            self.consume_history()
+            if self.listener is not None and self.listener in readable:
+                self.listener.drain()
+                if enabled == 'on':
+                    self.on_new_observation(min_interval)
+
+            if self.feed is not None:
+                if self.feed in readable:
+                    self.on_feed_data()
+                self.feed.check_idle()
+                self.feed.connect()
+                self.delivery.expire()
+                self.delivery.publish()
+
+            # Keep the APRS-IS session open between transmissions
+            if self.session is not None:
+                self.session.keepalive()
+
+            # Check if runtime ENV variables changed every 60 seconds
+            if time.time() >= next_env_check and self.running:
+                next_env_check = time.time() + ENV_CHECK_INTERVAL
+                new_enabled = os.getenv('APRS_AUTO_ENABLED', 'off').lower()
+                new_interval = int(os.getenv('APRS_UPDATE_INTERVAL', '3600'))
+
+                if new_enabled != enabled:
+                    enabled = new_enabled
+                    log.info("Configuration updated: enabled = %s", enabled)
+                    if enabled == 'off':
+                        log.info("Transmissions disabled - daemon will sleep")
                     else:
-                        meteo = {}
-                        print("Weather file not found - using empty data")
-                    
-                    # Send APRS packet
-                    send_aprs_packet(cfg, meteo, is_test=False)
-                    transmission_count += 1
-                    
-                    print(f"Transmission #{transmission_count} completed successfully")
-                    print(f"Next transmission in {interval} seconds")
-                    
-                except Exception as e:
-                    print(f"Error in transmission: {e}")
-                    if debug:
-                        import traceback
-                        traceback.print_exc()
-            
-            else:
-                # Only display this message once at startup
-                if transmission_count == 0:
-                    print("Daemon disabled via APRS_AUTO_ENABLED=off")
-                    print("Set APRS_AUTO_ENABLED=on to enable automatic transmissions")
-                    print(f"Sleeping for {interval} seconds...")
-            
-            # Sleep in small steps to allow quick shutdown
-            sleep_count = 0
-            while sleep_count < interval and self.running:
-                time.sleep(1)
-                sleep_count += 1
-                
-                # Check if runtime ENV variables changed every 60 seconds
-                if sleep_count % 60 == 0 and self.running:
-                    new_enabled = os.getenv('APRS_AUTO_ENABLED', 'off').lower()
-                    new_interval = int(os.getenv('APRS_UPDATE_INTERVAL', '3600'))
-                    
-                    if new_enabled != enabled:
-                        enabled = new_enabled
-                        print(f"Configuration updated: enabled = {enabled}")
-                        if enabled == 'off':
-                            print("Transmissions disabled - daemon will sleep")
-                        else:
-                            print("Transmissions enabled - resuming operations")
-                    
-                    if new_interval != interval:
-                        interval = new_interval
-                        print(f"Configuration updated: interval = {interval} seconds")
-        
-        print("APRS Daemon shutdown completed")
+                        log.info("Transmissions enabled - resuming operations")
+
+                if new_interval != interval:
+                    interval = new_interval
+                    log.info("Configuration updated: interval = %s seconds", interval)
+
+        if self.listener is not None:
+            self.listener.close()
+        if self.session is not None:
+            self.session.close()
+        if self.feed is not None:
+            self.feed.close()
+        log.info("APRS Daemon shutdown completed")
 
 def main():
-    print("Starting APRS Weather Station Daemon...")
+    log.info("Starting APRS Weather Station Daemon...")
+    profiling.install_signal_handler("APRSDaemon")
     try:
         daemon = APRSDaemon()
         daemon.run()
     except KeyboardInterrupt:
-        print("\nDaemon interrupted by user")
+        log.info("Daemon interrupted by user")
     except Exception as e:
-        print(f"Daemon error: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Daemon error: %s", e)
         sys.exit(1)
 
 if __name__ == "__main__":
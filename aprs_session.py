@@ -0,0 +1,342 @@
+# coding: utf-8
+# aprs_session.py - persistent APRS-IS session for the APRS daemon
+import select
+import time
+
+from aprs_logging import get_logger
+from metrics import registry
+from profiling import stage
+
+log = get_logger("aprs_session")
+
+CONNECT_SECONDS = registry.histogram(
+    'aprs_aprsis_connect_seconds', "APRS-IS connect and login time", ('server',))
+SEND_SECONDS = registry.histogram('aprs_aprsis_send_seconds', "APRS-IS packet write time")
+CONNECTIONS = registry.counter('aprs_aprsis_connections_total', "Successful APRS-IS logins", ('server',))
+FAILURES = registry.counter('aprs_aprsis_failures_total', "Failed APRS-IS operations", ('operation',))
+
+KEEPALIVE_INTERVAL = 120      # seconds of idle time before a keepalive comment is sent
+BACKOFF_INITIAL = 2           # seconds before the first reconnect attempt
+BACKOFF_MAX = 300             # upper bound for the reconnect delay
+# Servers send a comment line every ~20 s; a silent feed is considered dead after this
+FEED_IDLE_TIMEOUT = 120
+
+
+def parse_server_list(server, default_port):
+    """
+    Build a list of (host, port) tuples from the 'server' config value.
+    Multiple servers can be given comma separated, each optionally as host:port.
+    Ex: "euro.aprs2.net, noam.aprs2.net:14580"
+    """
+    servers = []
+    for entry in str(server).split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, sep, port = entry.rpartition(':')
+        if sep and port.isdigit():
+            servers.append((host, int(port)))
+        else:
+            servers.append((entry, int(default_port)))
+    return servers or [('euro.aprs2.net', int(default_port))]
+
+
+def full_callsign(cfg):
+    """Return the callsign with SSID appended when the SSID is valid"""
+    callsign_full = cfg['callsign']
+    if cfg['ssid']:
+        try:
+            n = int(cfg['ssid'])
+            if 0 <= n <= 15:
+                callsign_full = f"{cfg['callsign']}-{n}"
+        except ValueError:
+            pass
+    return callsign_full
+
+
+class APRSSession:
+    """
+    Long-lived APRS-IS connection kept open across transmissions.
+    Handles keepalives, dead socket detection, reconnection with
+    exponential backoff and failover across the configured server list.
+    """
+
+    def __init__(self, callsign, passcode, servers,
+                 keepalive=KEEPALIVE_INTERVAL, backoff_initial=BACKOFF_INITIAL,
+                 backoff_max=BACKOFF_MAX):
+        self.callsign = callsign
+        self.passcode = passcode
+        self.servers = list(servers)
+        self.keepalive_interval = keepalive
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+
+        self.ais = None
+        self.server_index = 0
+        self.backoff = 0
+        self.next_attempt = 0.0
+        self.last_activity = 0.0
+        self.connect_count = 0
+        # Called with every packet written to the server (delivery verification)
+        self.on_sent = None
+
+    @classmethod
+    def from_config(cls, cfg):
+        """Create a session from a read_config() dictionary"""
+        return cls(full_callsign(cfg), cfg['passcode'],
+                   parse_server_list(cfg['server'], cfg['port']))
+
+    def matches(self, cfg):
+        """True if this session was created for the same login and servers"""
+        return (self.callsign == full_callsign(cfg)
+                and self.passcode == cfg['passcode']
+                and self.servers == parse_server_list(cfg['server'], cfg['port']))
+
+    @property
+    def connected(self):
+        return self.ais is not None and self.ais._connected
+
+    def connect(self):
+        """
+        Connect and login, trying each server once starting from the last good one.
+        Raises ConnectionError if every server failed; the next attempt is then
+        delayed with exponential backoff.
+        """
+        if self.connected:
+            return
+        # aprslib is imported on first use to keep process start-up fast
+        import aprslib
+
+        now = time.time()
+        if now < self.next_attempt:
+            raise ConnectionError(
+                f"reconnect backoff active, next attempt in {self.next_attempt - now:.0f} seconds")
+
+        last_error = None
+        for attempt in range(len(self.servers)):
+            index = (self.server_index + attempt) % len(self.servers)
+            host, port = self.servers[index]
+            ais = aprslib.IS(self.callsign, self.passcode, host=host, port=port)
+            started = time.perf_counter()
+            try:
+                ais.connect()
+            except Exception as e:
+                log.error("[APRS-IS] Connection to %s:%s failed: %s", host, port, e)
+                FAILURES.inc('connect')
+                last_error = e
+                continue
+            server = f"{host}:{port}"
+            CONNECT_SECONDS.observe(time.perf_counter() - started, server)
+            CONNECTIONS.inc(server)
+
+            self.ais = ais
+            self.connect_count += 1
+            self.server_index = index
+            self.backoff = 0
+            self.next_attempt = 0.0
+            self.last_activity = time.time()
+            log.info("[APRS-IS] Session established with %s:%s as %s", host, port, self.callsign)
+            return
+
+        self.backoff = min(self.backoff * 2 if self.backoff else self.backoff_initial, self.backoff_max)
+        self.next_attempt = time.time() + self.backoff
+        log.error("[APRS-IS] All servers failed, retrying in %s seconds", self.backoff)
+        raise ConnectionError(f"all APRS-IS servers failed: {last_error}")
+
+    def close(self):
+        """Close the current connection; the next send reconnects"""
+        if self.ais is not None:
+            try:
+                self.ais.close()
+            except Exception:
+                pass
+        self.ais = None
+
+    def _drop(self, reason):
+        log.warning("[APRS-IS] Connection lost (%s), will reconnect", reason)
+        self.close()
+        # Fail over to the next server on the following connect
+        self.server_index = (self.server_index + 1) % len(self.servers)
+
+    def is_alive(self):
+        """
+        Check the socket without blocking. Pending server lines (banner,
+        keepalive comments) are drained; an EOF or socket error marks the
+        connection as dead.
+        """
+        if not self.connected:
+            return False
+        sock = self.ais.sock
+        try:
+            while True:
+                readable, _, _ = select.select([sock], [], [], 0)
+                if not readable:
+                    return True
+                data = sock.recv(4096)
+                if not data:
+                    self._drop("closed by server")
+                    return False
+        except (OSError, ValueError) as e:
+            self._drop(e)
+            return False
+
+    def send(self, packet):
+        """
+        Send one packet, reconnecting first if the socket is dead.
+        A failed write is retried once on a fresh connection.
+        """
+        import aprslib
+        for attempt in range(2):
+            if not self.is_alive():
+                with stage('connect'):
+                    self.connect()
+            started = time.perf_counter()
+            try:
+                with stage('send'):
+                    self.ais.sendall(packet)
+                self.last_activity = time.time()
+                SEND_SECONDS.observe(time.perf_counter() - started)
+                if self.on_sent is not None:
+                    self.on_sent(packet)
+                return
+            except (aprslib.ConnectionError, OSError) as e:
+                FAILURES.inc('send')
+                self._drop(e)
+                if attempt == 1:
+                    raise ConnectionError(f"send failed: {e}")
+
+    def keepalive(self):
+        """Send a comment line if the connection has been idle for too long"""
+        if not self.connected:
+            return
+        if time.time() - self.last_activity < self.keepalive_interval:
+            return
+        if not self.is_alive():
+            return
+        import aprslib
+        try:
+            self.ais.sendall("#keepalive")
+            self.last_activity = time.time()
+        except (aprslib.ConnectionError, OSError) as e:
+            FAILURES.inc('keepalive')
+            self._drop(e)
+
+
+def feed_filter(callsigns):
+    """Server-side budlist filter matching every SSID of the given callsigns (b/CALL*)"""
+    bases = sorted({callsign.split('-', 1)[0].upper() for callsign in callsigns})
+    return "b/" + "/".join(f"{base}*" for base in bases)
+
+
+class APRSFeed:
+    """
+    Receive-only APRS-IS connection (passcode -1) with a server-side filter,
+    read without blocking from the daemon loop. Reconnects with exponential
+    backoff; lines are returned without the CR LF terminator.
+    """
+
+    def __init__(self, login, servers, filter_text, idle_timeout=FEED_IDLE_TIMEOUT,
+                 backoff_initial=BACKOFF_INITIAL, backoff_max=BACKOFF_MAX):
+        self.login = login
+        self.servers = list(servers)
+        self.filter_text = filter_text
+        self.idle_timeout = idle_timeout
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+
+        self.ais = None
+        self.server_index = 0
+        self.backoff = 0
+        self.next_attempt = 0.0
+        self.last_received = 0.0
+        self.buffer = b''
+
+    @property
+    def connected(self):
+        return self.ais is not None
+
+    def fileno(self):
+        return self.ais.sock.fileno()
+
+    def connect(self, prefer_index=None):
+        """
+        Connect unless already connected or waiting for the backoff.
+        prefer_index starts with another server than the sending session's,
+        so an echo shows the packet travelled through the network.
+        Returns True when connected.
+        """
+        if self.connected:
+            return True
+        now = time.time()
+        if now < self.next_attempt:
+            return False
+        import aprslib
+
+        start = self.server_index if prefer_index is None else prefer_index
+        for attempt in range(len(self.servers)):
+            index = (start + attempt) % len(self.servers)
+            host, port = self.servers[index]
+            ais = aprslib.IS(self.login, "-1", host=host, port=port)
+            ais.set_filter(self.filter_text)
+            try:
+                ais.connect()
+            except Exception as e:
+                log.error("[APRS-IS feed] Connection to %s:%s failed: %s", host, port, e)
+                FAILURES.inc('feed_connect')
+                continue
+            ais.sock.setblocking(False)
+            self.ais = ais
+            self.server_index = index
+            self.backoff = 0
+            self.buffer = b''
+            self.last_received = time.time()
+            log.info("[APRS-IS feed] Receiving %s from %s:%s", self.filter_text, host, port)
+            return True
+
+        self.backoff = min(self.backoff * 2 if self.backoff else self.backoff_initial, self.backoff_max)
+        self.next_attempt = time.time() + self.backoff
+        return False
+
+    def close(self):
+        if self.ais is not None:
+            try:
+                self.ais.close()
+            except Exception:
+                pass
+        self.ais = None
+
+    def _drop(self, reason):
+        log.warning("[APRS-IS feed] Connection lost (%s), will reconnect", reason)
+        self.close()
+        self.next_attempt = time.time() + self.backoff_initial
+
+    def read_lines(self):
+        """Packets received since the last call; server comment lines are skipped"""
+        if not self.connected:
+            return []
+        try:
+            while True:
+                data = self.ais.sock.recv(65536)
+                if not data:
+                    self._drop("closed by server")
+                    break
+                self.buffer += data
+                self.last_received = time.time()
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            self._drop(e)
+
+        *lines, self.buffer = self.buffer.split(b'\r\n')
+        return [line.decode('utf-8', 'replace') for line in lines if line and not line.startswith(b'#')]
+
+    def check_idle(self):
+        """Drop a connection that stayed silent longer than idle_timeout"""
+        if self.connected and time.time() - self.last_received > self.idle_timeout:
+            self._drop(f"no data for {self.idle_timeout} seconds")
+
+    def next_wakeup(self):
+        """When the loop must call connect() or check_idle() again"""
+        if self.connected:
+            return self.last_received + self.idle_timeout
+        return self.next_attempt
@@ -0,0 +1,301 @@
+# coding: utf-8
+# async_server.py - pre-forked asyncio HTTP server for the weather data receiver
+import asyncio
+import io
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+from aprs_logging import get_logger
+
+log = get_logger("async_server")
+
+MAX_HEADER_SIZE = 16384
+MAX_BODY_SIZE = int(os.getenv('MAX_BODY_SIZE', str(8 * 1024 * 1024)))
+KEEPALIVE_TIMEOUT = 75
+# Longest time a client may take to send a request body
+BODY_TIMEOUT = 30
+# Threads per worker running the WSGI application, so a slow request
+# (archive query, disk flush) does not stall the event loop
+WEB_THREADS = int(os.getenv('WEB_THREADS', '8'))
+# How often a worker checks that the server process is still alive
+PARENT_CHECK_INTERVAL = 1.0
+REASONS = {
+    200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+    405: 'Method Not Allowed', 408: 'Request Timeout', 413: 'Payload Too Large', 429: 'Too Many Requests',
+    500: 'Internal Server Error', 503: 'Service Unavailable'
+}
+
+
+class BadRequest(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+async def _send_continue(writer, headers):
+    """Answer Expect: 100-continue, otherwise the client waits before sending the body"""
+    if writer is not None and headers.get('expect', '').lower() == '100-continue':
+        writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        await writer.drain()
+
+
+async def _read_body(reader, headers, writer=None):
+    """Read a request body with Content-Length or chunked transfer encoding"""
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        await _send_continue(writer, headers)
+        chunks = []
+        size = 0
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            length = int(line.split(b';', 1)[0].strip(), 16)
+            if length == 0:
+                await reader.readuntil(b'\r\n')
+                break
+            size += length
+            if size > MAX_BODY_SIZE:
+                raise BadRequest(413, "request body too large")
+            chunks.append(await reader.readexactly(length))
+            await reader.readexactly(2)
+        return b''.join(chunks)
+
+    length = int(headers.get('content-length') or 0)
+    if length > MAX_BODY_SIZE:
+        raise BadRequest(413, "request body too large")
+    if not length:
+        return b''
+    await _send_continue(writer, headers)
+    return await reader.readexactly(length)
+
+
+def _build_environ(method, target, version, headers, body, peer, server):
+    path, _, query = target.partition('?')
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': unquote(path, 'latin-1'),
+        'QUERY_STRING': query,
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': version,
+        'REMOTE_ADDR': peer[0] if peer else '',
+        'REMOTE_PORT': str(peer[1]) if peer else '',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in headers.items():
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name not in ('content-length', 'transfer-encoding'):
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+    return environ
+
+
+def _call_app(app, environ):
+    """Run the WSGI application and return (status line, headers, body)"""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+        response['headers'] = headers
+
+    result = app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], response['headers'], body
+
+
+def _error_response(writer, status, message):
+    body = (message + "\n").encode('utf-8')
+    writer.write(
+        f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+        f"Content-Type: text/plain\r\nContent-Length: {len(body)}\r\n"
+        f"Connection: close\r\n\r\n".encode('latin-1') + body)
+
+
+async def handle_connection(app, reader, writer):
+    """Serve HTTP/1.x requests on one connection, with keep-alive"""
+    peer = writer.get_extra_info('peername')
+    server = writer.get_extra_info('sockname') or ('0.0.0.0', 0)
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEPALIVE_TIMEOUT)
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                break
+            except asyncio.LimitOverrunError:
+                _error_response(writer, 400, "request header too large")
+                break
+
+            try:
+                lines = head.decode('latin-1').split('\r\n')
+                method, target, version = lines[0].split(' ', 2)
+                headers = {}
+                for line in lines[1:]:
+                    if line:
+                        name, _, value = line.partition(':')
+                        headers[name.strip().lower()] = value.strip()
+                # A slow client must not hold the worker
+                body = await asyncio.wait_for(_read_body(reader, headers, writer), BODY_TIMEOUT)
+            except BadRequest as e:
+                _error_response(writer, e.status, str(e))
+                break
+            except asyncio.TimeoutError:
+                _error_response(writer, 408, "request body timeout")
+                break
+            except (ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                _error_response(writer, 400, "malformed request")
+                break
+            except ConnectionError:
+                break
+
+            environ = _build_environ(method, target, version, headers, body, peer, server)
+            try:
+                status, response_headers, response_body = await loop.run_in_executor(
+                    None, _call_app, app, environ)
+            except Exception as e:
+                log.exception("Unhandled application error: %s", e)
+                _error_response(writer, 500, "internal server error")
+                break
+
+            connection = headers.get('connection', '').lower()
+            keep_alive = (connection == 'keep-alive' if version == 'HTTP/1.0'
+                          else connection != 'close')
+
+            out = [f"HTTP/1.1 {status}\r\n"]
+            has_length = False
+            for name, value in response_headers:
+                if name.lower() == 'content-length':
+                    has_length = True
+                out.append(f"{name}: {value}\r\n")
+            if not has_length:
+                out.append(f"Content-Length: {len(response_body)}\r\n")
+            out.append("Connection: keep-alive\r\n\r\n" if keep_alive else "Connection: close\r\n\r\n")
+            if method == 'HEAD':
+                response_body = b''
+            writer.write(''.join(out).encode('latin-1') + response_body)
+            await writer.drain()
+
+            if not keep_alive:
+                break
+    finally:
+        try:
+            writer.close()
+        except Exception:
+            pass
+
+
+def create_listen_socket(host, port, reuse_port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.setblocking(False)
+    return sock
+
+
+def run_worker(app, host, port, sock=None, ready=None, on_exit=None):
+    """
+    Event loop of one worker process; binds its own SO_REUSEPORT socket when sock is None.
+    ready (a multiprocessing.Event) is set once the worker accepts connections.
+    on_exit is called once the loop has stopped, before the process exits.
+    The worker stops by itself when the server process dies.
+    """
+    parent = os.getppid()
+    if sock is None:
+        sock = create_listen_socket(host, port, reuse_port=True)
+
+    async def watch_parent(stop):
+        # An orphaned worker would keep accepting on the SO_REUSEPORT port
+        # next to the workers of a restarted server
+        while os.getppid() == parent:
+            await asyncio.sleep(PARENT_CHECK_INTERVAL)
+        log.warning("Async worker %s lost its server process, stopping", os.getpid())
+        stop.set()
+
+    async def main():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(WEB_THREADS, thread_name_prefix="wsgi"))
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+        server = await asyncio.start_server(
+            lambda r, w: handle_connection(app, r, w), sock=sock, limit=MAX_HEADER_SIZE)
+        async with server:
+            if ready is not None:
+                ready.set()
+            watchdog = asyncio.create_task(watch_parent(stop))
+            await stop.wait()
+            watchdog.cancel()
+
+    log.info("Async worker %s listening on %s:%s", os.getpid(), host, port)
+    try:
+        asyncio.run(main())
+    finally:
+        if on_exit is not None:
+            on_exit()
+
+
+def serve(app, host="0.0.0.0", port=5000, workers=None, ready=None, on_exit=None):
+    """
+    Start `workers` pre-forked worker processes (default: one per core).
+    With SO_REUSEPORT each worker binds its own socket and the kernel spreads
+    connections; otherwise the workers share one inherited listening socket.
+    Blocks until terminated, restarting workers that exit unexpectedly.
+    ready is set as soon as the first worker is accepting connections.
+    on_exit is called in each worker when it stops.
+    """
+    workers = workers or os.cpu_count() or 1
+    reuse_port = hasattr(socket, 'SO_REUSEPORT')
+    shared = None if reuse_port else create_listen_socket(host, port, reuse_port=False)
+    ctx = multiprocessing.get_context('fork')
+
+    def spawn(index):
+        process = ctx.Process(target=run_worker, args=(app, host, port, shared, ready, on_exit),
+                              name=f"AsyncWorker-{index}")
+        process.start()
+        return process
+
+    processes = [spawn(i) for i in range(workers)]
+    log.info("Async server started with %d workers on %s:%s (SO_REUSEPORT: %s)",
+             workers, host, port, reuse_port)
+
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    from multiprocessing.connection import wait
+    while not stopping:
+        wait([p.sentinel for p in processes], timeout=5)
+        for index, process in enumerate(processes):
+            if not process.is_alive() and not stopping:
+                log.warning("Async worker %s exited with code %s, restarting", process.pid, process.exitcode)
+                processes[index] = spawn(index)
+
+    for process in processes:
+        process.join(timeout=10)
+        if process.is_alive():
+            process.kill()
@@ -0,0 +1,167 @@
+# coding: utf-8
+# aprsis_emulator.py - local asyncio stand-in for an APRS-IS server
+#
+# Usage: python benchmarks/aprsis_emulator.py [--port 14580] [--latency 0.05]
+#                                             [--drop 0.01] [--disconnect 0.001]
+# Speaks the APRS-IS login handshake, verifies passcodes, records packets and
+# can inject latency, packet drops and disconnects for send-path testing.
+import argparse
+import asyncio
+import random
+import threading
+import time
+
+import aprslib
+
+SERVER_NAME = "EMULATOR"
+KEEPALIVE_INTERVAL = 20
+
+
+class APRSISEmulator:
+    """
+    Fake APRS-IS server.
+    latency:     seconds added before the login response and each processed packet
+    drop_rate:   probability a packet is silently discarded
+    disconnect_rate: probability the connection is closed after a packet
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, drop_rate=0.0,
+                 disconnect_rate=0.0, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.disconnect_rate = disconnect_rate
+        self.random = random.Random(seed)
+
+        self.packets = []           # (receive time, login callsign, packet line)
+        self.stats = {
+            'connections': 0, 'logins_verified': 0, 'logins_unverified': 0,
+            'packets': 0, 'dropped': 0, 'rejected_unverified': 0, 'disconnects_injected': 0,
+        }
+        self.loop = None
+        self.server = None
+        self.thread = None
+
+    async def _handle(self, reader, writer):
+        self.stats['connections'] += 1
+        keepalive = None
+        try:
+            writer.write(f"# aprsis-emulator {SERVER_NAME}\r\n".encode('latin-1'))
+            await writer.drain()
+
+            login = (await reader.readline()).decode('latin-1').split()
+            if len(login) < 4 or login[0] != 'user' or login[2] != 'pass':
+                writer.write(b"# invalid login\r\n")
+                return
+            callsign, passcode = login[1], login[3]
+            verified = passcode == str(aprslib.passcode(callsign.split('-')[0]))
+            self.stats['logins_verified' if verified else 'logins_unverified'] += 1
+
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            status = "verified" if verified else "unverified"
+            writer.write(f"# logresp {callsign} {status}, server {SERVER_NAME}\r\n".encode('latin-1'))
+            await writer.drain()
+            keepalive = asyncio.ensure_future(self._keepalive(writer))
+
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.rstrip(b'\r\n').decode('latin-1')
+                if not line or line.startswith('#'):
+                    continue
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                if not verified:
+                    self.stats['rejected_unverified'] += 1
+                    continue
+                if self.drop_rate and self.random.random() < self.drop_rate:
+                    self.stats['dropped'] += 1
+                    continue
+                self.packets.append((time.time(), callsign, line))
+                self.stats['packets'] += 1
+                if self.disconnect_rate and self.random.random() < self.disconnect_rate:
+                    self.stats['disconnects_injected'] += 1
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Emulator shutdown: finish quietly so the stream callback sees no error
+            pass
+        finally:
+            if keepalive is not None:
+                keepalive.cancel()
+            writer.close()
+
+    async def _keepalive(self, writer):
+        """Real servers send a comment line every 20 seconds"""
+        while True:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            writer.write(f"# {SERVER_NAME} keepalive\r\n".encode('latin-1'))
+            await writer.drain()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    def start_in_thread(self):
+        """Run the emulator on its own event loop thread; returns once listening"""
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self.start())
+            ready.set()
+            self.loop.run_forever()
+            self.loop.close()
+
+        self.thread = threading.Thread(target=run, name="APRSISEmulator", daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self
+
+    async def _shutdown(self):
+        self.server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        """Close every connection and stop the thread started by start_in_thread()"""
+        if self.loop is not None and self.server is not None:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(timeout=5)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local APRS-IS emulator")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=14580)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added per packet")
+    parser.add_argument('--drop', type=float, default=0.0, help="packet drop probability")
+    parser.add_argument('--disconnect', type=float, default=0.0, help="disconnect probability per packet")
+    args = parser.parse_args()
+
+    emulator = APRSISEmulator(args.host, args.port, args.latency, args.drop, args.disconnect)
+
+    async def run():
+        await emulator.start()
+        print(f"APRS-IS emulator listening on {args.host}:{emulator.port}")
+        while True:
+            await asyncio.sleep(10)
+            print(f"Stats: {emulator.stats}")
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        print(f"Final stats: {emulator.stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# coding: utf-8
+# bench_encoder.py - microbenchmark of APRS packet encoding for all wx_format modes
+#
+# Usage: python benchmarks/bench_encoder.py [--stations N] [--rounds N]
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aprs_send import PacketEncoder, get_encoder  # noqa: E402
+
+METEO = {
+    'temperature': 21.5, 'humidity': 64.0, 'pressure': 1013.2,
+    'wind_speed': 3.4, 'wind_direction': 270.0, 'wind_gust': 6.1,
+    'rain_1h': 0.4, 'rain_24h': 3.2, 'dewpoint': 14.3
+}
+
+
+def station_configs(count, wx_format):
+    """Distinct station configurations spread over a grid of positions"""
+    return [{
+        'callsign': f"N{i % 10}CALL", 'ssid': str(i % 16), 'passcode': '00000',
+        'server': 'localhost', 'port': 14580, 'comment_prefix': '',
+        'comment': 'Python APRS Weather Station', 'comment_wx': 'Weather Station',
+        'test_message': 'TEST', 'send_weather': 'yes', 'wx_format': wx_format,
+        'restore_icon': 'yes', 'symbol_table': '/', 'symbol_code': '_',
+        'interval': None, 'meteo_file': '/config/meteo.json',
+        'lat': 35.0 + (i % 100) * 0.1, 'lon': 10.0 + (i // 100) * 0.1
+    } for i in range(count)]
+
+
+def encode_cycle(encoder, meteo):
+    """Packets of one transmission cycle, as send_aprs_packet builds them"""
+    if encoder.mode == 'wx-text':
+        packets = [encoder.position_packet(encoder.comment_wx), encoder.wx_packet(meteo)]
+        if encoder.restore_icon:
+            packets.append(encoder.position_packet())
+        return packets
+    if encoder.mode == 'wx':
+        return [encoder.wx_packet(meteo)]
+    return [encoder.text_packet(meteo)]
+
+
+def bench(label, func, rounds):
+    start = time.perf_counter()
+    packets = 0
+    for _ in range(rounds):
+        packets += func()
+    elapsed = time.perf_counter() - start
+    return {
+        'name': label,
+        'seconds': elapsed,
+        'packets': packets,
+        'packets_per_second': packets / elapsed if elapsed else 0.0,
+        'usec_per_packet': elapsed / packets * 1e6 if packets else 0.0,
+    }
+
+
+def run(stations=1000, rounds=20):
+    """Run encoder benchmarks and return a list of result dictionaries"""
+    logging.getLogger('aprs_send').setLevel(logging.ERROR)
+    results = []
+    for wx_format in ('text', 'wx', 'wx-text'):
+        configs = station_configs(stations, wx_format)
+        encoders = [PacketEncoder(cfg) for cfg in configs]
+
+        def precompiled():
+            return sum(len(encode_cycle(encoder, METEO)) for encoder in encoders)
+
+        def cached_lookup():
+            return sum(len(encode_cycle(get_encoder(cfg), METEO)) for cfg in configs)
+
+        def cold():
+            return sum(len(encode_cycle(PacketEncoder(cfg), METEO)) for cfg in configs)
+
+        results.append(bench(f"encode[{wx_format}] precompiled", precompiled, rounds))
+        results.append(bench(f"encode[{wx_format}] get_encoder", cached_lookup, rounds))
+        results.append(bench(f"encode[{wx_format}] cold build", cold, rounds))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="APRS packet encoder microbenchmark")
+    parser.add_argument('--stations', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    for result in run(args.stations, args.rounds):
+        print(f"{result['name']:<36} {result['packets_per_second']:>12,.0f} packets/s "
+              f"{result['usec_per_packet']:>8.2f} us/packet")
+
+
+if __name__ == "__main__":
+    main()
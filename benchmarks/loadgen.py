@@ -0,0 +1,135 @@
+# coding: utf-8
+# loadgen.py - drive many simulated stations through send_aprs_packet
+#
+# Usage: python benchmarks/loadgen.py [--stations 200] [--cycles 5] [--mode wx]
+#                                     [--per-packet] [--server host:port]
+#                                     [--latency 0.001] [--drop 0.01] [--disconnect 0.01]
+#                                     [--pace 0.002]
+# Without --server a local APRS-IS emulator is started with the given faults.
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import aprslib  # noqa: E402
+
+import aprs_send  # noqa: E402
+from aprs_session import APRSSession  # noqa: E402
+from aprsis_emulator import APRSISEmulator  # noqa: E402
+from bench_encoder import METEO, station_configs  # noqa: E402
+
+
+def build_stations(count, mode, host, port):
+    configs = station_configs(count, mode)
+    for cfg in configs:
+        cfg['server'] = host
+        cfg['port'] = port
+        cfg['passcode'] = str(aprslib.passcode(cfg['callsign']))
+        # Delayed sends are not part of the load being measured
+        cfg['restore_icon'] = 'no'
+    return configs
+
+
+def run(stations=200, cycles=5, mode='wx', per_packet=False, server=None,
+        latency=0.0, drop=0.0, disconnect=0.0, pace=0.0):
+    """
+    Send `cycles` rounds of packets for every station and return a result dictionary.
+    pace adds a pause between stations so injected disconnects are noticed by
+    the sender instead of being hidden behind already-buffered writes.
+    """
+    logging.getLogger().setLevel(logging.ERROR)
+    emulator = None
+    if server:
+        host, _, port = server.partition(':')
+        port = int(port or 14580)
+    else:
+        emulator = APRSISEmulator(latency=latency, drop_rate=drop,
+                                  disconnect_rate=disconnect, seed=1).start_in_thread()
+        host, port = emulator.host, emulator.port
+
+    configs = build_stations(stations, mode, host, port)
+    session = None if per_packet else APRSSession.from_config(configs[0])
+    # wx-text waits between packets; the load generator only measures sending
+    original_sleep = aprs_send.time.sleep
+    aprs_send.time.sleep = lambda seconds: None
+
+    sent = failed = 0
+    original_raw = aprs_send.send_aprs_packet_raw
+
+    def counting_raw(cfg, packet, session=None):
+        nonlocal sent, failed
+        if original_raw(cfg, packet, session):
+            sent += 1
+            return True
+        failed += 1
+        return False
+
+    aprs_send.send_aprs_packet_raw = counting_raw
+    start = time.perf_counter()
+    try:
+        for _ in range(cycles):
+            for cfg in configs:
+                aprs_send.send_aprs_packet(cfg, METEO, session=session)
+                if pace:
+                    original_sleep(pace)
+    finally:
+        elapsed = time.perf_counter() - start
+        aprs_send.send_aprs_packet_raw = original_raw
+        aprs_send.time.sleep = original_sleep
+        if session is not None:
+            session.close()
+
+    if emulator is not None:
+        # Let the emulator finish processing buffered lines
+        deadline = time.time() + 5
+        while emulator.stats['packets'] + emulator.stats['dropped'] < sent and time.time() < deadline:
+            time.sleep(0.01)
+        emulator.stop()
+
+    result = {
+        'stations': stations,
+        'cycles': cycles,
+        'mode': mode,
+        'transport': 'per-packet' if per_packet else 'shared-session',
+        'seconds': elapsed,
+        'packets_sent': sent,
+        'packets_failed': failed,
+        'packets_lost': (sent - emulator.stats['packets']) if emulator is not None else None,
+        'packets_per_second': sent / elapsed if elapsed else 0.0,
+        'reconnects': session.connect_count - 1 if session is not None else None,
+    }
+    if emulator is not None:
+        result['server'] = dict(emulator.stats)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="APRS-IS send path load generator")
+    parser.add_argument('--stations', type=int, default=200)
+    parser.add_argument('--cycles', type=int, default=5)
+    parser.add_argument('--mode', choices=('text', 'wx', 'wx-text'), default='wx')
+    parser.add_argument('--per-packet', action='store_true',
+                        help="connect and login for every packet (legacy path)")
+    parser.add_argument('--server', help="host:port of an existing server instead of the emulator")
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--drop', type=float, default=0.0)
+    parser.add_argument('--disconnect', type=float, default=0.0)
+    parser.add_argument('--pace', type=float, default=0.0, help="seconds between stations")
+    parser.add_argument('--output', help="write the result as JSON to this file")
+    args = parser.parse_args()
+
+    result = run(args.stations, args.cycles, args.mode, args.per_packet, args.server,
+                 args.latency, args.drop, args.disconnect, args.pace)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
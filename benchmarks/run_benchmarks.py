@@ -0,0 +1,222 @@
+# coding: utf-8
+# run_benchmarks.py - benchmark suite for ingest, validation, encoding and end-to-end send
+#
+# Usage: python benchmarks/run_benchmarks.py [--quick] [--output results.json]
+# Results are written as JSON so runs can be compared.
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+WORKDIR = tempfile.mkdtemp(prefix="aprs-bench-")
+# Keep every benchmark away from /config and /dev/shm of a running station
+os.environ.setdefault('LATEST_OBS_PATH', os.path.join(WORKDIR, "latest_observation"))
+os.environ.setdefault('OBS_NOTIFY_PATH', os.path.join(WORKDIR, "notify.sock"))
+os.environ.setdefault('METRICS_DIR', os.path.join(WORKDIR, "metrics"))
+os.environ.setdefault('APRS_OUTBOX_PATH', os.path.join(WORKDIR, "outbox.log"))
+os.environ.setdefault('ARCHIVE_DIR', os.path.join(WORKDIR, "archive"))
+os.environ.setdefault('HISTORY_PATH', os.path.join(WORKDIR, "history"))
+# Ingest benchmarks post far above any per-client budget
+os.environ.setdefault('RATE_LIMIT_RATE', '0')
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+os.environ.setdefault('LOG_RATE_LIMIT', '0')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import app  # noqa: E402
+import aprs_send  # noqa: E402
+import bench_encoder  # noqa: E402
+from aprsis_emulator import APRSISEmulator  # noqa: E402
+
+app.DATA_PATH = os.path.join(WORKDIR, "meteo.json")
+app.latest.snapshot_path = app.DATA_PATH
+aprs_send.CONFIG_FILE = os.path.join(WORKDIR, "aprs_config.ini")
+aprs_send.DEFAULT_CONFIG_FILE = os.path.join(WORKDIR, "missing-defaults.ini")
+aprs_send.METEO_FILE = app.DATA_PATH
+aprs_send.STATIONS_DIR = os.path.join(WORKDIR, "stations.d")
+
+CLEAN = {
+    'temperature': 21.5, 'humidity': 64, 'pressure': 1013.2, 'wind_speed': 3.4,
+    'wind_direction': 270, 'wind_gust': 6.1, 'rain_1h': 0.4, 'rain_24h': 3.2, 'dewpoint': 14.3
+}
+COMMA = {k: str(v).replace('.', ',') for k, v in CLEAN.items()}
+OUT_OF_RANGE = dict(CLEAN, temperature=99, humidity=140, pressure=500, wind_direction='n/a')
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(name, func, iterations, warmup=None):
+    """Call func() `iterations` times and report throughput and latency percentiles"""
+    for _ in range(warmup if warmup is not None else max(1, iterations // 10)):
+        func()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'name': name,
+        'iterations': iterations,
+        'seconds': elapsed,
+        'ops_per_second': iterations / elapsed if elapsed else 0.0,
+        'latency_us': {
+            'mean': elapsed / iterations * 1e6,
+            'p50': percentile(latencies, 0.50) * 1e6,
+            'p95': percentile(latencies, 0.95) * 1e6,
+            'p99': percentile(latencies, 0.99) * 1e6,
+            'max': latencies[-1] * 1e6,
+        }
+    }
+
+
+def bench_ingest(iterations):
+    client = app.app.test_client()
+    query = "&".join(f"{k}={v}" for k, v in COMMA.items())
+    results = [
+        measure("meteo GET query-string", lambda: client.get(f"/meteo?{query}"), iterations),
+        measure("meteo POST json", lambda: client.post("/meteo", json=CLEAN), iterations),
+    ]
+    # A client over its budget is answered before the body is parsed
+    app.limiter.limits['192.0.2.1'] = (0.001, 1)
+    try:
+        results.append(measure("meteo POST json over budget (429)",
+                               lambda: client.post("/meteo", json=CLEAN, environ_base={'REMOTE_ADDR': '192.0.2.1'}),
+                               iterations))
+    finally:
+        del app.limiter.limits['192.0.2.1']
+    return results
+
+
+def bench_validation(iterations):
+    return [
+        measure("validate clean", lambda: app.validate_weather_data(CLEAN), iterations),
+        measure("validate comma-decimal", lambda: app.validate_weather_data(COMMA), iterations),
+        measure("validate out-of-range", lambda: app.validate_weather_data(OUT_OF_RANGE), iterations),
+    ]
+
+
+def bench_encoding(iterations, cfg):
+    results = [measure("format_wx_standard", lambda: aprs_send.format_wx_standard(CLEAN), iterations)]
+
+    sent = []
+    original_raw = aprs_send.send_aprs_packet_raw
+    aprs_send.send_aprs_packet_raw = lambda c, packet, session=None: sent.append(packet) or True
+    try:
+        for wx_format in ('text', 'wx', 'wx-compressed'):
+            mode_cfg = dict(cfg, wx_format=wx_format)
+            results.append(measure(f"send_aprs_packet build [{wx_format}]",
+                                   lambda: aprs_send.send_aprs_packet(mode_cfg, CLEAN), iterations))
+            sent.clear()
+    finally:
+        aprs_send.send_aprs_packet_raw = original_raw
+
+    rounds = max(1, iterations // 1000)
+    for result in bench_encoder.run(stations=1000, rounds=rounds):
+        results.append({
+            'name': result['name'],
+            'iterations': result['packets'],
+            'seconds': result['seconds'],
+            'ops_per_second': result['packets_per_second'],
+            'latency_us': {'mean': result['usec_per_packet']},
+        })
+    return results
+
+
+def bench_daemon_cycle(iterations):
+    """Full daemon transmission (config, data load, encode, send) against a local server"""
+    from aprs_send_daemon import APRSDaemon
+
+    server = APRSISEmulator().start_in_thread()
+    with open(aprs_send.CONFIG_FILE, 'w') as f:
+        f.write(f"""[APRS]
+callsign = N0CALL
+ssid = 13
+passcode = 13023
+server = 127.0.0.1:{server.port}
+send_weather = yes
+wx_format = wx
+
+[Station]
+lat = 42.0
+lon = 12.0
+""")
+    app.latest.publish(CLEAN)
+
+    daemon = APRSDaemon()
+    daemon.initialize_system()
+    station = daemon.stations[0]
+    try:
+        result = measure("daemon cycle [wx] to local APRS-IS", lambda: daemon.transmit(station), iterations)
+        deadline = time.time() + 5
+        while server.stats['packets'] < station['count'] and time.time() < deadline:
+            time.sleep(0.01)
+        result['packets_received'] = server.stats['packets']
+        return [result]
+    finally:
+        if daemon.session is not None:
+            daemon.session.close()
+        server.stop()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="APRS weather station benchmark suite")
+    parser.add_argument('--quick', action='store_true', help="fewer iterations")
+    parser.add_argument('--output', default='bench_results.json', help="JSON results file")
+    args = parser.parse_args()
+
+    n = 200 if args.quick else 2000
+    cfg = aprs_send.parse_config({
+        'APRS': {'callsign': 'N0CALL', 'ssid': '13', 'passcode': '13023', 'send_weather': 'yes'},
+        'Station': {'lat': '42.0', 'lon': '12.0'}
+    })
+
+    suites = {
+        'ingest': lambda: bench_ingest(n),
+        'validation': lambda: bench_validation(n * 10),
+        'encoding': lambda: bench_encoding(n * 10, cfg),
+        'daemon': lambda: bench_daemon_cycle(max(20, n // 10)),
+    }
+
+    report = {
+        'timestamp': time.time(),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'quick': args.quick,
+        'results': {},
+    }
+    for suite, func in suites.items():
+        report['results'][suite] = results = func()
+        for result in results:
+            print(f"{suite:<11} {result['name']:<40} {result['ops_per_second']:>12,.0f} ops/s "
+                  f"mean {result['latency_us']['mean']:>9.1f} us")
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
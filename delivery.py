@@ -0,0 +1,144 @@
+# coding: utf-8
+# delivery.py - end-to-end delivery verification: match our packets echoed by the APRS-IS feed
+import collections
+import json
+import os
+import time
+
+from aprs_logging import get_logger
+from latest_observation import SHM_DIR
+from metrics import registry
+
+log = get_logger("delivery")
+
+# Packets not seen on the feed within this many seconds are counted as lost
+DELIVERY_TIMEOUT = int(os.getenv('APRS_DELIVERY_TIMEOUT', '120'))
+# Shared with the receiver, which reports the statistics in /status
+STATS_PATH = os.getenv('APRS_DELIVERY_STATS_PATH', os.path.join(SHM_DIR, "aprs_delivery.json"))
+LATENCY_SAMPLES = 100
+
+RESULTS = registry.counter('aprs_delivery_total', "Sent packets by delivery result", ('result',))
+NETWORK_SECONDS = registry.histogram('aprs_delivery_latency_seconds',
+                                     "Time from packet write to its echo on the APRS-IS feed")
+DATA_SECONDS = registry.histogram('aprs_delivery_data_latency_seconds',
+                                  "Time from observation to its packet echoed on the APRS-IS feed",
+                                  buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+
+
+def packet_key(packet):
+    """(source callsign, information field) identifying a TNC2 packet whatever its path"""
+    header, _, info = packet.partition(':')
+    return header.split('>', 1)[0].strip().upper(), info.rstrip('\r\n')
+
+
+def _summary(samples):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return {
+        'last': round(samples[-1], 3),
+        'mean': round(sum(ordered) / len(ordered), 3),
+        'p50': round(ordered[len(ordered) // 2], 3),
+        'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+        'max': round(ordered[-1], 3),
+    }
+
+
+class DeliveryTracker:
+    """
+    Packets written to APRS-IS, waiting to be seen again on a receive-only
+    feed. A packet matches an echo with the same source and information
+    field (the path is rewritten by the servers). Unmatched packets expire
+    as lost after `timeout` seconds.
+    """
+
+    def __init__(self, timeout=DELIVERY_TIMEOUT, stats_path=STATS_PATH, samples=LATENCY_SAMPLES):
+        self.timeout = timeout
+        self.stats_path = stats_path
+        self.pending = {}       # packet key -> (sent at, observation timestamp or None)
+        self.network_latency = collections.deque(maxlen=samples)
+        self.data_latency = collections.deque(maxlen=samples)
+        # sent = confirmed + lost + pending; identical resends are counted apart
+        self.counts = {'sent': 0, 'resent': 0, 'confirmed': 0, 'lost': 0}
+        self.last_confirmed = None
+        self.dirty = True
+
+    def sent(self, packet, data_timestamp=None):
+        """Record a packet written to the APRS-IS session"""
+        # A resent identical packet keeps its first send time
+        key = packet_key(packet)
+        if key in self.pending:
+            self.counts['resent'] += 1
+        else:
+            self.pending[key] = (time.time(), data_timestamp)
+            self.counts['sent'] += 1
+        self.dirty = True
+
+    def received(self, line):
+        """Match one line from the feed; returns True if it confirmed a sent packet"""
+        import aprslib
+        try:
+            parsed = aprslib.parse(line)
+            key = (parsed['from'].upper(), parsed['raw'].partition(':')[2].rstrip('\r\n'))
+        except Exception:
+            # Formats aprslib does not decode can still be matched on the raw line
+            key = packet_key(line)
+        entry = self.pending.pop(key, None)
+        if entry is None:
+            return False
+
+        now = time.time()
+        sent_at, data_timestamp = entry
+        self.network_latency.append(now - sent_at)
+        NETWORK_SECONDS.observe(now - sent_at)
+        if data_timestamp is not None:
+            self.data_latency.append(now - data_timestamp)
+            DATA_SECONDS.observe(now - data_timestamp)
+        self.counts['confirmed'] += 1
+        self.last_confirmed = now
+        self.dirty = True
+        RESULTS.inc('confirmed')
+        log.info("Delivery confirmed after %.2f s: %s", now - sent_at, line)
+        return True
+
+    def expire(self, now=None):
+        """Count packets not echoed within the timeout as lost"""
+        now = time.time() if now is None else now
+        expired = [key for key, (sent_at, _) in self.pending.items() if now - sent_at > self.timeout]
+        for key in expired:
+            del self.pending[key]
+            self.counts['lost'] += 1
+            RESULTS.inc('lost')
+            log.warning("Delivery not confirmed within %s s: %s>...:%s", self.timeout, key[0], key[1])
+        if expired:
+            self.dirty = True
+
+    def next_expiry(self):
+        """Time the oldest pending packet expires, None if nothing is pending"""
+        if not self.pending:
+            return None
+        return min(sent_at for sent_at, _ in self.pending.values()) + self.timeout
+
+    def stats(self):
+        resolved = self.counts['confirmed'] + self.counts['lost']
+        return dict(self.counts,
+                    pending=len(self.pending),
+                    loss_ratio=round(self.counts['lost'] / resolved, 4) if resolved else None,
+                    last_confirmed=self.last_confirmed,
+                    latency=_summary(self.network_latency),
+                    data_latency=_summary(self.data_latency),
+                    timeout=self.timeout)
+
+    def publish(self):
+        """Write the statistics for /status when they changed (atomic rename)"""
+        if not self.dirty or not self.stats_path:
+            return
+        self.dirty = False
+        tmp_path = f"{self.stats_path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.stats(), f)
+            os.replace(tmp_path, self.stats_path)
+        except OSError as e:
+            log.error("Delivery stats write error: %s", e)
+
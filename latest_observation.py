@@ -0,0 +1,261 @@
+# coding: utf-8
+# latest_observation.py - shared-memory channel for the latest validated observation
+import fcntl
+import json
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+
+from aprs_logging import get_logger
+
+log = get_logger("latest_observation")
+
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else "/tmp"
+SEGMENT_PATH = os.getenv('LATEST_OBS_PATH', os.path.join(SHM_DIR, "aprs_latest_observation"))
+SEGMENT_SIZE = 4096
+SNAPSHOT_INTERVAL = int(os.getenv('METEO_SNAPSHOT_INTERVAL', '60'))
+# Unix datagram socket the daemon listens on for new-observation notifications
+NOTIFY_PATH = os.getenv('OBS_NOTIFY_PATH', os.path.join(SHM_DIR, "aprs_observation_notify.sock"))
+# Restart and downtime statistics written by the service manager, reported by /status
+SERVICE_STATS_PATH = os.getenv('SERVICE_STATS_PATH', os.path.join(SHM_DIR, "aprs_services.json"))
+
+# seq (odd while a write is in progress), observation timestamp, payload length
+HEADER = struct.Struct('<QdI')
+MAX_PAYLOAD = SEGMENT_SIZE - HEADER.size
+READ_RETRIES = 1000
+
+
+def _open_segment(path, create):
+    """Map the segment file, creating it with the full size if requested"""
+    if create:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(fd).st_size < SEGMENT_SIZE:
+            os.ftruncate(fd, SEGMENT_SIZE)
+    else:
+        fd = os.open(path, os.O_RDONLY)
+        if os.fstat(fd).st_size < SEGMENT_SIZE:
+            os.close(fd)
+            return None, None
+    access = mmap.ACCESS_WRITE if create else mmap.ACCESS_READ
+    return fd, mmap.mmap(fd, SEGMENT_SIZE, access=access)
+
+
+class LatestObservation:
+    """
+    Seqlock-protected shared-memory segment holding the latest observation.
+    Writers (any number of processes/threads) serialize on flock plus a thread
+    lock; readers never block writers and retry while a write is in progress.
+    The JSON file is only written as a periodic, atomically renamed snapshot.
+    """
+
+    def __init__(self, path=SEGMENT_PATH, snapshot_path=None, snapshot_interval=SNAPSHOT_INTERVAL,
+                 notify_path=NOTIFY_PATH):
+        self.path = path
+        self.notify_path = notify_path
+        self.notify_sock = None
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.fd = None
+        self.mem = None
+        self.lock = threading.Lock()
+        self.dirty = threading.Event()
+        self.snapshot_thread = None
+        self.latest = None
+
+    def _writer_map(self):
+        if self.mem is None:
+            self.fd, self.mem = _open_segment(self.path, create=True)
+        return self.mem
+
+    def publish(self, observation, timestamp=None):
+        """Store a new observation; no filesystem I/O besides the mmap'd segment"""
+        timestamp = time.time() if timestamp is None else timestamp
+        payload = json.dumps(observation, separators=(',', ':')).encode('utf-8')
+        if len(payload) > MAX_PAYLOAD:
+            raise ValueError(f"observation too large for shared segment ({len(payload)} bytes)")
+
+        with self.lock:
+            mem = self._writer_map()
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                seq = HEADER.unpack_from(mem, 0)[0]
+                # Odd sequence marks the segment as being written
+                struct.pack_into('<Q', mem, 0, seq + 1)
+                mem[HEADER.size:HEADER.size + len(payload)] = payload
+                struct.pack_into('<dI', mem, 8, timestamp, len(payload))
+                struct.pack_into('<Q', mem, 0, seq + 2)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.latest = (observation, timestamp)
+            self._notify()
+
+        if self.snapshot_path:
+            self.dirty.set()
+            self._ensure_snapshot_thread()
+
+    def _notify(self):
+        """Wake the daemon; a missing or busy listener is not an error"""
+        if not self.notify_path:
+            return
+        try:
+            if self.notify_sock is None:
+                self.notify_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                self.notify_sock.setblocking(False)
+            self.notify_sock.sendto(b'1', self.notify_path)
+        except OSError:
+            pass
+
+    def _ensure_snapshot_thread(self):
+        if self.snapshot_thread is None:
+            self.snapshot_thread = threading.Thread(target=self._snapshot_loop,
+                                                    name="MeteoSnapshot", daemon=True)
+            self.snapshot_thread.start()
+
+    def _snapshot_loop(self):
+        while True:
+            self.dirty.wait()
+            time.sleep(self.snapshot_interval)
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        """
+        Write the latest observation to snapshot_path using an atomic rename.
+        Every writer process runs this: they serialize on a lock file and take
+        the observation from the shared segment, so the last snapshot written
+        is never older than another process's value.
+        """
+        if not self.dirty.is_set() or self.latest is None:
+            return
+        self.dirty.clear()
+        tmp_path = f"{self.snapshot_path}.tmp"
+        try:
+            fd = os.open(f"{self.path}.snapshot.lock", os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                current = read_latest_observation(self.path)
+                observation = current[0] if current is not None else self.latest[0]
+                with open(tmp_path, 'w') as f:
+                    json.dump(observation, f, indent=2)
+                os.replace(tmp_path, self.snapshot_path)
+            finally:
+                os.close(fd)
+        except Exception as e:
+            log.error("Weather snapshot error: %s", e)
+            self.dirty.set()
+
+
+class ObservationListener:
+    """Receiving end of the new-observation notifications (used by the daemon)"""
+
+    def __init__(self, path=NOTIFY_PATH):
+        self.path = path
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+        self.sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def drain(self):
+        """Consume pending notifications, returning how many were received"""
+        count = 0
+        while True:
+            try:
+                self.sock.recv(64)
+                count += 1
+            except BlockingIOError:
+                return count
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def read_latest_observation(path=SEGMENT_PATH):
+    """
+    Return (observation, timestamp) from the shared segment, or None if no
+    observation has been published yet or the segment does not exist.
+    """
+    try:
+        fd, mem = _open_segment(path, create=False)
+    except OSError:
+        return None
+    if mem is None:
+        return None
+    try:
+        for attempt in range(READ_RETRIES):
+            seq, timestamp, length = HEADER.unpack_from(mem, 0)
+            if seq == 0:
+                return None
+            if seq & 1 or length > MAX_PAYLOAD:
+                time.sleep(0)
+                continue
+            payload = mem[HEADER.size:HEADER.size + length]
+            if HEADER.unpack_from(mem, 0)[0] == seq:
+                return json.loads(payload), timestamp
+        return None
+    finally:
+        mem.close()
+        os.close(fd)
+
+
+class LatestObservationReader:
+    """
+    Reader keeping the segment mapped between calls, for callers polling the
+    version of the latest observation. sequence() is a single header read.
+    """
+
+    def __init__(self, path=SEGMENT_PATH):
+        self.path = path
+        self.mem = None
+
+    def _map(self):
+        if self.mem is None:
+            try:
+                fd, mem = _open_segment(self.path, create=False)
+            except OSError:
+                return None
+            if mem is None:
+                return None
+            os.close(fd)
+            self.mem = mem
+        return self.mem
+
+    def sequence(self):
+        """Even sequence number of the latest published observation, 0 if none"""
+        mem = self._map()
+        if mem is None:
+            return 0
+        for attempt in range(READ_RETRIES):
+            seq = HEADER.unpack_from(mem, 0)[0]
+            if not seq & 1:
+                return seq
+            time.sleep(0)
+        return seq + 1
+
+    def read(self):
+        return read_latest_observation(self.path)
+
+
+def load_observation(meteo_file):
+    """
+    Latest observation for the sender: the shared segment first, then the
+    JSON snapshot file. Returns {} when neither is available.
+    """
+    latest = read_latest_observation()
+    if latest is not None:
+        return latest[0]
+    if os.path.exists(meteo_file):
+        with open(meteo_file) as f:
+            return json.load(f)
+    return {}
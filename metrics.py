@@ -0,0 +1,274 @@
+# coding: utf-8
+# metrics.py - Prometheus-style counters and histograms shared between processes
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+
+from aprs_logging import get_logger
+from latest_observation import SHM_DIR
+
+log = get_logger("metrics")
+
+# Every process publishes its metrics as <pid>.json in this tmpfs directory;
+# the /metrics endpoint merges them so one scrape covers receiver and daemon
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(SHM_DIR, "aprs_metrics"))
+PUBLISH_INTERVAL = float(os.getenv('METRICS_PUBLISH_INTERVAL', '5'))
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    """Monotonic counter, one value per combination of label values"""
+    type = 'counter'
+
+    def __init__(self, registry, name, help, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, *labels):
+        self.add(1, *labels)
+
+    def add(self, amount, *labels):
+        with self.registry.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+        self.registry.changed()
+
+    def inc_many(self, label_sets):
+        """Increment several label combinations by one under a single lock"""
+        values = self.values
+        with self.registry.lock:
+            for labels in label_sets:
+                values[labels] = values.get(labels, 0) + 1
+        self.registry.changed()
+
+    def snapshot(self):
+        return {'type': self.type, 'help': self.help, 'labelnames': self.labelnames,
+                'samples': [[list(labels), value] for labels, value in self.values.items()]}
+
+
+class Histogram:
+    """Latency histogram; bucket counts are stored per bucket and made cumulative on output"""
+    type = 'histogram'
+
+    def __init__(self, registry, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}    # labels -> [count per bucket..., +Inf count, sum]
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.registry.lock:
+            data = self.values.get(labels)
+            if data is None:
+                data = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            data[index] += 1
+            data[-1] += value
+        self.registry.changed()
+
+    def time(self, *labels):
+        """Context manager observing the duration of the block"""
+        return _Timer(self, labels)
+
+    def snapshot(self):
+        return {'type': self.type, 'help': self.help, 'labelnames': self.labelnames,
+                'buckets': self.buckets,
+                'samples': [[list(labels), list(data)] for labels, data in self.values.items()]}
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+        return False
+
+
+class MetricsRegistry:
+    """
+    Metrics of the current process. Values live in plain dictionaries; a
+    background thread writes them to METRICS_DIR at most every `interval`
+    seconds, and only after something changed.
+    """
+
+    def __init__(self, directory=METRICS_DIR, interval=PUBLISH_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.dirty = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def _register(self, metric):
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(self, name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, help, labelnames, buckets))
+
+    def changed(self):
+        if not self.dirty.is_set():
+            self.dirty.set()
+        if self.thread is None and self.directory:
+            self._start_publisher()
+
+    def _start_publisher(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._publish_loop, name="MetricsPublisher", daemon=True)
+            self.thread.start()
+        atexit.register(self.remove)
+
+    def _publish_loop(self):
+        while True:
+            self.dirty.wait()
+            self.publish()
+            time.sleep(self.interval)
+
+    def after_fork(self):
+        """A forked child starts with empty values and its own publisher"""
+        self.lock = threading.Lock()
+        self.dirty = threading.Event()
+        self.thread = None
+        for metric in self.metrics.values():
+            metric.values = {}
+
+    def snapshot(self):
+        with self.lock:
+            return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def publish(self):
+        """Write this process' values to METRICS_DIR using an atomic rename"""
+        self.dirty.clear()
+        path = self._path(os.getpid())
+        tmp_path = f"{path}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(self.snapshot(), f, separators=(',', ':'))
+            os.replace(tmp_path, path)
+        except Exception as e:
+            log.error("Metrics publish error: %s", e)
+
+    def remove(self):
+        if self.pid == os.getpid():
+            try:
+                os.unlink(self._path(self.pid))
+            except OSError:
+                pass
+
+    def _shared_snapshots(self):
+        """Snapshots published by the other live processes; stale files are removed"""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        own = f"{os.getpid()}.json"
+        for name in names:
+            if not name.endswith('.json') or name == own:
+                continue
+            try:
+                os.kill(int(name[:-5]), 0)
+            except ProcessLookupError:
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+                continue
+            except (ValueError, PermissionError):
+                pass
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    yield json.load(f)
+            except (OSError, ValueError):
+                continue
+
+    def collect(self):
+        """Merge this process' live values with every other process' published values"""
+        merged = {}
+        for snapshot in [self.snapshot(), *self._shared_snapshots()]:
+            for name, metric in snapshot.items():
+                target = merged.setdefault(name, dict(metric, samples={}))
+                samples = target['samples']
+                for labels, value in metric['samples']:
+                    labels = tuple(labels)
+                    if metric['type'] == 'histogram':
+                        current = samples.get(labels)
+                        samples[labels] = list(value) if current is None else [a + b for a, b in zip(current, value)]
+                    else:
+                        samples[labels] = samples.get(labels, 0) + value
+        return merged
+
+    def render(self, gauges=()):
+        """
+        Prometheus text exposition of all processes' metrics.
+        gauges: extra (name, help, value) computed at scrape time.
+        """
+        lines = []
+        for name, help, value in gauges:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {_format_value(value)}")
+
+        for name, metric in sorted(self.collect().items()):
+            labelnames = metric['labelnames']
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for labels, value in sorted(metric['samples'].items()):
+                pairs = list(zip(labelnames, labels))
+                if metric['type'] != 'histogram':
+                    lines.append(f"{name}{_format_labels(pairs)} {_format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(metric['buckets']) + ['+Inf'], value[:-1]):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else _format_value(bound)
+                    lines.append(f"{name}_bucket{_format_labels(pairs + [('le', le)])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(pairs)} {_format_value(value[-1])}")
+                lines.append(f"{name}_count{_format_labels(pairs)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value) if value == value else "NaN"
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+registry = MetricsRegistry()
+os.register_at_fork(after_in_child=registry.after_fork)
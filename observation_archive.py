@@ -0,0 +1,349 @@
+# coding: utf-8
+# observation_archive.py - append-only binary archive of observations with rollup tiers
+import fcntl
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+from aprs_logging import get_logger
+from observation_history import FIELDS
+
+log = get_logger("observation_archive")
+
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', "/config/archive")
+# Samples are buffered in memory and written in one block per interval,
+# so the SD card sees a few large writes instead of one per observation
+FLUSH_INTERVAL = int(os.getenv('ARCHIVE_FLUSH_INTERVAL', '300'))
+FLUSH_RECORDS = 1024
+RAW_RETENTION = int(os.getenv('ARCHIVE_RAW_RETENTION', str(30 * 86400)))
+MINUTE_RETENTION = int(os.getenv('ARCHIVE_MINUTE_RETENTION', str(90 * 86400)))
+
+# Rollup tiers: bucket size in seconds, each built from the tier before it
+TIERS = {'1m': 60, '1h': 3600, '1d': 86400}
+MAX_POINTS = 2000
+RAW_SAMPLE_INTERVAL = 10    # assumed sample spacing when choosing a resolution
+CATCHUP_BUCKETS = 1440      # buckets rolled up per pass, bounds memory on first run
+
+NAN = float('nan')
+# timestamp, one float32 per field (NaN when missing)
+RAW_RECORD = struct.Struct('<d%df' % len(FIELDS))
+# bucket start, sample count, then min/mean/max float32 per field
+ROLLUP_RECORD = struct.Struct('<dI%df' % (3 * len(FIELDS)))
+TIMESTAMP = struct.Struct('<d')
+
+
+class RecordFile:
+    """Fixed-width records kept sorted by their leading float64 timestamp"""
+
+    def __init__(self, path, record):
+        self.path = path
+        self.record = record
+
+    def _bisect(self, mem, count, timestamp):
+        """First record index whose timestamp is >= timestamp"""
+        size = self.record.size
+        low, high = 0, count
+        while low < high:
+            mid = (low + high) // 2
+            if TIMESTAMP.unpack_from(mem, mid * size)[0] < timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def read_range(self, start=None, end=None):
+        """Records with start <= timestamp < end, located by binary search over an mmap"""
+        size = self.record.size
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return []
+        try:
+            count = os.fstat(fd).st_size // size
+            if not count:
+                return []
+            with mmap.mmap(fd, count * size, access=mmap.ACCESS_READ) as mem:
+                first = self._bisect(mem, count, start) if start is not None else 0
+                last = self._bisect(mem, count, end) if end is not None else count
+                if first >= last:
+                    return []
+                return list(self.record.iter_unpack(mem[first * size:last * size]))
+        finally:
+            os.close(fd)
+
+    def first_timestamp(self):
+        return self._timestamp_at(0)
+
+    def last_timestamp(self):
+        return self._timestamp_at(-1)
+
+    def _timestamp_at(self, index):
+        size = self.record.size
+        try:
+            with open(self.path, 'rb') as f:
+                count = os.fstat(f.fileno()).st_size // size
+                if not count:
+                    return None
+                f.seek((index % count) * size)
+                return TIMESTAMP.unpack(f.read(TIMESTAMP.size))[0]
+        except FileNotFoundError:
+            return None
+
+    def merge(self, packed_records):
+        """
+        Add records (bytes, sorted) keeping the file sorted. Records newer than
+        the file end are appended; otherwise only the overlapping tail is rewritten.
+        Callers hold the archive lock.
+        """
+        if not packed_records:
+            return
+        size = self.record.size
+        first_ts = TIMESTAMP.unpack_from(packed_records, 0)[0]
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            count = os.fstat(fd).st_size // size
+            position = count
+            if count:
+                with mmap.mmap(fd, count * size, access=mmap.ACCESS_READ) as mem:
+                    position = self._bisect(mem, count, first_ts)
+                    tail = mem[position * size:count * size]
+                if tail:
+                    records = sorted(list(self.record.iter_unpack(tail)) +
+                                     list(self.record.iter_unpack(packed_records)),
+                                     key=lambda record: record[0])
+                    packed_records = b''.join(self.record.pack(*record) for record in records)
+            os.pwrite(fd, packed_records, position * size)
+            os.ftruncate(fd, position * size + len(packed_records))
+        finally:
+            os.close(fd)
+
+    def keep_since(self, timestamp):
+        """Drop records older than timestamp (rewrites the file)"""
+        records = self.read_range(start=timestamp)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(self.record.pack(*record) for record in records))
+        os.replace(tmp_path, self.path)
+
+
+def _rollup(start, records, from_rollup):
+    """
+    Reduce the records of one bucket to a rollup tuple.
+    Raw records contribute their values; rollup records their min/mean/max,
+    with means weighted by sample count.
+    """
+    n = len(FIELDS)
+    count = 0
+    stats = []
+    for i in range(n):
+        stats.append([math.inf, 0.0, -math.inf, 0])     # min, weighted sum, max, weight
+    for record in records:
+        if from_rollup:
+            weight = record[1]
+            count += weight
+            values = record[2:]
+            for i in range(n):
+                mean = values[3 * i + 1]
+                if mean != mean:
+                    continue
+                s = stats[i]
+                s[0] = min(s[0], values[3 * i])
+                s[1] += mean * weight
+                s[2] = max(s[2], values[3 * i + 2])
+                s[3] += weight
+        else:
+            count += 1
+            for i, value in enumerate(record[1:]):
+                if value != value:
+                    continue
+                s = stats[i]
+                if value < s[0]:
+                    s[0] = value
+                if value > s[2]:
+                    s[2] = value
+                s[1] += value
+                s[3] += 1
+    out = [start, count]
+    for s in stats:
+        if s[3]:
+            out.extend((s[0], s[1] / s[3], s[2]))
+        else:
+            out.extend((NAN, NAN, NAN))
+    return out
+
+
+class ObservationArchive:
+    """
+    Long-term record of observations under ARCHIVE_DIR:
+    raw.bin holds every sample, rollup_1m/1h/1d.bin the per-bucket min/mean/max.
+    Any number of processes may append; writes and compaction are serialized
+    by an flock on archive.lock, and readers only use mmap.
+    """
+
+    def __init__(self, directory=ARCHIVE_DIR, flush_interval=FLUSH_INTERVAL,
+                 raw_retention=RAW_RETENTION, minute_retention=MINUTE_RETENTION):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.raw = RecordFile(os.path.join(directory, "raw.bin"), RAW_RECORD)
+        self.rollups = {name: RecordFile(os.path.join(directory, f"rollup_{name}.bin"), ROLLUP_RECORD)
+                        for name in TIERS}
+        # 1h and 1d rollups are kept forever
+        self.retention = [(self.raw, raw_retention), (self.rollups['1m'], minute_retention)]
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def append(self, timestamp, values):
+        """Buffer one observation; it reaches the disk on the next flush"""
+        record = RAW_RECORD.pack(timestamp, *(values.get(field, NAN) for field in FIELDS))
+        with self.lock:
+            self.buffer.append(record)
+            full = len(self.buffer) >= FLUSH_RECORDS
+        if full:
+            self.flush()
+        if self.thread is None:
+            self._start()
+
+    def _start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._loop, name="ObservationArchive", daemon=True)
+            self.thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                self.compact()
+            except Exception as e:
+                log.error("Archive maintenance error: %s", e)
+
+    def _locked(self, blocking=True):
+        """Open and flock archive.lock; returns the fd or None if busy"""
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(os.path.join(self.directory, "archive.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def flush(self):
+        """Write buffered samples to raw.bin in a single write"""
+        with self.lock:
+            buffer, self.buffer = self.buffer, []
+        if not buffer:
+            return
+        buffer.sort(key=lambda record: TIMESTAMP.unpack_from(record)[0])
+        try:
+            fd = self._locked()
+            try:
+                self.raw.merge(b''.join(buffer))
+            finally:
+                os.close(fd)
+        except OSError as e:
+            log.error("Archive write error: %s", e)
+            with self.lock:
+                self.buffer[:0] = buffer
+
+    def compact(self, now=None):
+        """
+        Roll complete buckets up into the 1m, 1h and 1d tiers and apply the raw
+        and 1m retention. Skipped when another process is already compacting.
+        """
+        now = time.time() if now is None else now
+        fd = self._locked(blocking=False)
+        if fd is None:
+            return
+        try:
+            source, from_rollup = self.raw, False
+            for name, step in TIERS.items():
+                self._compact_tier(self.rollups[name], step, source, from_rollup, now)
+                source, from_rollup = self.rollups[name], True
+
+            for records, retention in self.retention:
+                first = records.first_timestamp()
+                # Rewrite the file at most once a day
+                if first is not None and first < now - retention - 86400:
+                    records.keep_since(now - retention)
+                    log.info("Archive: %s records older than %s days removed",
+                             os.path.basename(records.path), retention // 86400)
+        finally:
+            os.close(fd)
+
+    def _compact_tier(self, target, step, source, from_rollup, now):
+        # Buckets are final once every process had the chance to flush into them
+        cutoff = (now - self.flush_interval) // step * step
+        last = target.last_timestamp()
+        if last is not None:
+            start = last + step
+        else:
+            first = source.first_timestamp()
+            if first is None:
+                return
+            start = first // step * step
+
+        while start < cutoff:
+            end = min(cutoff, start + step * CATCHUP_BUCKETS)
+            buckets = {}
+            for record in source.read_range(start, end):
+                buckets.setdefault(record[0] // step * step, []).append(record)
+            packed = b''.join(ROLLUP_RECORD.pack(*_rollup(bucket, records, from_rollup))
+                              for bucket, records in sorted(buckets.items()))
+            target.merge(packed)
+            start = end
+
+    def query(self, start=None, end=None, fields=None, resolution='auto'):
+        """
+        Return archived observations with start <= timestamp < end.
+        resolution: 'raw', '1m', '1h', '1d' or 'auto' (coarsest tier giving at
+        most MAX_POINTS points). Rollups return min/mean/max per field.
+        """
+        fields = [f for f in (fields or FIELDS) if f in FIELDS]
+        indexes = [FIELDS.index(f) for f in fields]
+        end_time = end if end is not None else time.time()
+        if resolution == 'auto':
+            first = self.raw.first_timestamp() if start is None else start
+            span = end_time - (first if first is not None else end_time)
+            resolution = 'raw'
+            if span / RAW_SAMPLE_INTERVAL > MAX_POINTS:
+                resolution = next((name for name, step in TIERS.items() if span / step <= MAX_POINTS), '1d')
+        if resolution != 'raw' and resolution not in TIERS:
+            raise ValueError(f"unknown resolution '{resolution}'")
+
+        if resolution == 'raw':
+            records = self.raw.read_range(start, end)
+            with self.lock:
+                pending = [RAW_RECORD.unpack(record) for record in self.buffer]
+            if pending:
+                pending = [r for r in pending if (start is None or r[0] >= start) and (end is None or r[0] < end)]
+                records = sorted(records + pending, key=lambda record: record[0])
+            return {
+                'resolution': 'raw',
+                'timestamps': [r[0] for r in records],
+                'fields': {f: [_value(r[1 + i]) for r in records] for f, i in zip(fields, indexes)},
+            }
+
+        records = self.rollups[resolution].read_range(start, end)
+        return {
+            'resolution': resolution,
+            'step': TIERS[resolution],
+            'timestamps': [r[0] for r in records],
+            'counts': [r[1] for r in records],
+            'fields': {
+                f: {stat: [_value(r[2 + 3 * i + k]) for r in records]
+                    for k, stat in enumerate(('min', 'mean', 'max'))}
+                for f, i in zip(fields, indexes)
+            },
+        }
+
+
+def _value(value):
+    """float32 values rounded back to a readable precision, NaN as None"""
+    return None if value != value else round(value, 4)
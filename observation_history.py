@@ -0,0 +1,252 @@
+# coding: utf-8
+# observation_history.py - shared-memory ring buffer of received weather observations
+import fcntl
+import math
+import mmap
+import os
+import struct
+import threading
+
+from latest_observation import SHM_DIR
+
+FIELDS = (
+    'temperature', 'humidity', 'pressure', 'wind_speed',
+    'wind_direction', 'wind_gust', 'rain_1h', 'rain_24h', 'dewpoint'
+)
+
+# Raw tipping-bucket tips per sample, summed into rain totals by the daemon
+RAW_COLUMNS = ('rain_tips',)
+COLUMNS = FIELDS + RAW_COLUMNS
+
+# 24 hours of samples at one every 10 seconds
+DEFAULT_CAPACITY = 8640
+CAPACITY = int(os.getenv('HISTORY_CAPACITY', DEFAULT_CAPACITY))
+# Shared by every receiver process (async workers, UDP ingest) and /history
+HISTORY_PATH = os.getenv('HISTORY_PATH', os.path.join(SHM_DIR, "aprs_history"))
+# Live samples up to this many seconds older than the newest one (concurrent
+# writers, clock steps) are stored at the newest timestamp instead of dropped
+CLOCK_SLACK = 1.0
+
+NAN = float('nan')
+# magic, column count, capacity, samples ever appended, last rain_counter (NaN if none)
+HEADER = struct.Struct('<4sIQQd')
+MAGIC = b'OBSH'
+
+
+class ObservationHistory:
+    """
+    Fixed-size ring buffer with one packed float column per known field,
+    kept in a file under /dev/shm so every process appends to and reads the
+    same samples. Size is (1 + len(COLUMNS)) * 8 bytes * capacity.
+    Missing values are stored as NaN. Samples are kept in time order.
+    A cumulative rain_counter is stored as rain_tips since the previous
+    counter value, so counter samples from any process are counted once;
+    a counter that goes down is taken as the new baseline with no tips.
+    Writers serialize on flock plus a thread lock; readers take a shared flock.
+    With path=None the buffer is private to the process.
+    """
+
+    def __init__(self, capacity=CAPACITY, path=HISTORY_PATH):
+        self.path = path
+        self.requested_capacity = max(1, int(capacity))
+        self.capacity = self.requested_capacity
+        self.fd = None
+        self.mem = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def _size(self, capacity):
+        return HEADER.size + 8 * capacity * (1 + len(COLUMNS))
+
+    def _map(self):
+        """Map the buffer; reopened after fork so each process has its own flock"""
+        if self.mem is not None and (self.fd is None or self.pid == os.getpid()):
+            return self.mem
+        capacity = self.requested_capacity
+        if self.path is None:
+            fd = None
+            mem = mmap.mmap(-1, self._size(capacity), flags=mmap.MAP_PRIVATE)
+            HEADER.pack_into(mem, 0, MAGIC, len(COLUMNS), capacity, 0, NAN)
+        else:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                size = os.fstat(fd).st_size
+                header = None
+                if size >= HEADER.size:
+                    header = HEADER.unpack(os.pread(fd, HEADER.size, 0))
+                if (header is not None and header[:2] == (MAGIC, len(COLUMNS))
+                        and size == self._size(header[2])):
+                    # Created by another process: its capacity wins until the segment is removed
+                    capacity = header[2]
+                else:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, self._size(capacity))
+                    os.pwrite(fd, HEADER.pack(MAGIC, len(COLUMNS), capacity, 0, NAN), 0)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            mem = mmap.mmap(fd, self._size(capacity))
+        self.fd, self.mem, self.pid = fd, mem, os.getpid()
+        self.capacity = capacity
+        view = memoryview(mem)
+        stride = 8 * capacity
+        self.timestamps = view[HEADER.size:HEADER.size + stride].cast('d')
+        self.columns = {}
+        for i, field in enumerate(COLUMNS, 1):
+            offset = HEADER.size + i * stride
+            self.columns[field] = view[offset:offset + stride].cast('d')
+        return mem
+
+    def _flock(self, operation):
+        if self.fd is not None:
+            fcntl.flock(self.fd, operation)
+
+    def _total(self):
+        return HEADER.unpack_from(self.mem, 0)[3]
+
+    def __len__(self):
+        with self.lock:
+            self._map()
+            return min(self._total(), self.capacity)
+
+    def append(self, timestamp, values, strict=False):
+        """
+        Store one observation; the oldest sample is overwritten when full.
+        A sample older than the newest stored one is dropped when strict
+        (backfilled batches), otherwise stored at the newest timestamp if
+        within CLOCK_SLACK. Returns the stored timestamp, None if dropped.
+        """
+        with self.lock:
+            mem = self._map()
+            self._flock(fcntl.LOCK_EX)
+            try:
+                total = self._total()
+                capacity = self.capacity
+                if total:
+                    last = self.timestamps[(total - 1) % capacity]
+                    if timestamp < last:
+                        if strict or last - timestamp > CLOCK_SLACK:
+                            return None
+                        timestamp = last
+                tips = values.get('rain_tips')
+                if 'rain_counter' in values:
+                    counter = values['rain_counter']
+                    previous = HEADER.unpack_from(mem, 0)[4]
+                    tips = tips or 0.0
+                    # A smaller value (reset, wrap, replayed or reordered sample) only
+                    # becomes the new baseline: adding it would invent rain
+                    if previous == previous and counter > previous:
+                        tips += counter - previous
+                    struct.pack_into('<d', mem, 24, counter)
+                index = total % capacity
+                self.timestamps[index] = timestamp
+                for field, column in self.columns.items():
+                    value = tips if field == 'rain_tips' else values.get(field)
+                    column[index] = NAN if value is None else value
+                struct.pack_into('<Q', mem, 16, total + 1)
+            finally:
+                self._flock(fcntl.LOCK_UN)
+        return timestamp
+
+    def last_timestamp(self):
+        with self.lock:
+            self._map()
+            self._flock(fcntl.LOCK_SH)
+            try:
+                total = self._total()
+                if not total:
+                    return None
+                return self.timestamps[(total - 1) % self.capacity]
+            finally:
+                self._flock(fcntl.LOCK_UN)
+
+    def read_since(self, cursor, fields):
+        """
+        Samples appended after the first `cursor` ones, as (timestamp, value, ...)
+        tuples with None for missing values. Returns (new cursor, number of
+        samples overwritten before they could be read, samples).
+        """
+        with self.lock:
+            self._map()
+            self._flock(fcntl.LOCK_SH)
+            try:
+                total = self._total()
+                oldest = max(0, total - self.capacity)
+                if cursor > total:
+                    # The segment was recreated
+                    cursor = oldest
+                first = max(cursor, oldest)
+                columns = [self.columns[f] for f in fields]
+                samples = []
+                for n in range(first, total):
+                    p = n % self.capacity
+                    samples.append((self.timestamps[p],) +
+                                   tuple(None if math.isnan(c[p]) else c[p] for c in columns))
+            finally:
+                self._flock(fcntl.LOCK_UN)
+        return total, first - cursor, samples
+
+    def _bisect(self, oldest, count, timestamp):
+        """First logical position whose timestamp is >= timestamp"""
+        low, high = 0, count
+        while low < high:
+            mid = (low + high) // 2
+            if self.timestamps[(oldest + mid) % self.capacity] < timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def query(self, start=None, end=None, step=None, fields=None):
+        """
+        Return samples with start <= timestamp <= end.
+        With step (seconds) the range is downsampled to one averaged point per
+        step-sized bucket. NaN values are returned as None.
+        """
+        fields = [f for f in (fields or COLUMNS) if f in COLUMNS]
+        with self.lock:
+            self._map()
+            self._flock(fcntl.LOCK_SH)
+            try:
+                total = self._total()
+                count = min(total, self.capacity)
+                oldest = (total - count) % self.capacity
+                first = self._bisect(oldest, count, start) if start is not None else 0
+                last = self._bisect(oldest, count, math.nextafter(end, math.inf)) if end is not None else count
+                positions = [(oldest + i) % self.capacity for i in range(first, last)]
+                timestamps = [self.timestamps[p] for p in positions]
+                columns = {f: [self.columns[f][p] for p in positions] for f in fields}
+            finally:
+                self._flock(fcntl.LOCK_UN)
+
+        if step and step > 0 and timestamps:
+            timestamps, columns = _downsample(timestamps, columns, step)
+
+        return {
+            'timestamps': timestamps,
+            'fields': {
+                f: [None if math.isnan(v) else v for v in values]
+                for f, values in columns.items()
+            }
+        }
+
+
+def _downsample(timestamps, columns, step):
+    """Average samples into buckets aligned on multiples of step"""
+    buckets = []
+    bucket_start = None
+    for i, ts in enumerate(timestamps):
+        key = ts - ts % step
+        if key != bucket_start:
+            buckets.append((key, i))
+            bucket_start = key
+    bounds = [index for _, index in buckets] + [len(timestamps)]
+
+    out_columns = {}
+    for field, values in columns.items():
+        out = []
+        for b in range(len(buckets)):
+            chunk = [v for v in values[bounds[b]:bounds[b + 1]] if not math.isnan(v)]
+            out.append(sum(chunk) / len(chunk) if chunk else NAN)
+        out_columns[field] = out
+    return [key for key, _ in buckets], out_columns
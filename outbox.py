@@ -0,0 +1,191 @@
+# coding: utf-8
+# outbox.py - durable queue of outbound APRS packets with retry and delayed sends
+import json
+import os
+import time
+
+from aprs_logging import get_logger
+from metrics import registry
+
+log = get_logger("outbox")
+
+OUTBOX_PATH = os.getenv('APRS_OUTBOX_PATH', "/config/aprs_outbox.log")
+MAX_AGE = int(os.getenv('APRS_OUTBOX_MAX_AGE', '86400'))     # packets older than this are dropped
+RETRY_INITIAL = 5
+RETRY_MAX = 600
+COMPACT_RECORDS = 1000      # rewrite the log after this many records
+
+EVENTS = registry.counter('aprs_outbox_total', "Outbox packets by event", ('event',))
+
+
+class Outbox:
+    """
+    Outbound packets that could not be sent yet, or are scheduled for later.
+    State changes are appended to a JSON-lines log and replayed on start, so
+    queued packets survive restarts. A packet sent successfully on the first
+    attempt never touches the disk; the log is removed once the queue is empty.
+
+    An entry can follow another one (`after`): it becomes due `delay` seconds
+    after its predecessor was sent, which keeps multi-packet sequences in order.
+    """
+
+    def __init__(self, path=OUTBOX_PATH, max_age=MAX_AGE,
+                 retry_initial=RETRY_INITIAL, retry_max=RETRY_MAX):
+        self.path = path
+        self.max_age = max_age
+        self.retry_initial = retry_initial
+        self.retry_max = retry_max
+        self.pending = {}       # id -> entry dictionary
+        self.next_id = 1
+        self.records = 0
+        self._load()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def _load(self):
+        """Replay the log left by a previous run"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        log.warning("Outbox: skipping corrupt record in %s", self.path)
+                        continue
+                    self._apply(record)
+                    self.records += 1
+        except OSError as e:
+            log.error("Outbox: cannot read %s: %s", self.path, e)
+            return
+
+        now = time.time()
+        for entry in self.pending.values():
+            # The predecessor was sent but the restart happened before its follower was released
+            if entry['due'] is None and entry['after'] not in self.pending:
+                entry['due'] = now + entry['delay']
+        if self.pending:
+            log.info("Outbox: %d queued packet(s) restored from %s", len(self.pending), self.path)
+        self._compact()
+
+    def _apply(self, record):
+        op = record.get('op')
+        entry_id = record.get('id')
+        if op == 'add':
+            self.pending[entry_id] = {key: record.get(key) for key in
+                                      ('id', 'packet', 'created', 'due', 'after', 'delay', 'attempts')}
+            self.next_id = max(self.next_id, entry_id + 1)
+        elif op == 'done':
+            self.pending.pop(entry_id, None)
+        elif op == 'update' and entry_id in self.pending:
+            self.pending[entry_id].update(due=record['due'], attempts=record['attempts'])
+
+    def _write(self, *records):
+        """Append records and flush them to disk"""
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a') as f:
+                for record in records:
+                    f.write(json.dumps(record, separators=(',', ':')) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            log.error("Outbox: cannot write %s: %s", self.path, e)
+        self.records += len(records)
+
+    def _compact(self):
+        """Rewrite the log with only the pending entries (or remove it when empty)"""
+        try:
+            if not self.pending:
+                if os.path.exists(self.path):
+                    os.unlink(self.path)
+            else:
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, 'w') as f:
+                    for entry in self.pending.values():
+                        f.write(json.dumps(dict(entry, op='add'), separators=(',', ':')) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+        except OSError as e:
+            log.error("Outbox: cannot compact %s: %s", self.path, e)
+            return
+        self.records = len(self.pending)
+
+    def _retry_delay(self, attempts):
+        return min(self.retry_initial * 2 ** (attempts - 1), self.retry_max)
+
+    def _queue(self, packet, due, after=None, delay=0, attempts=0):
+        entry = {'id': self.next_id, 'packet': packet, 'created': time.time(), 'due': due,
+                 'after': after, 'delay': delay, 'attempts': attempts}
+        self.next_id += 1
+        self.pending[entry['id']] = entry
+        self._write(dict(entry, op='add'))
+        return entry['id']
+
+    def submit(self, packet, send, delay=0, after=None):
+        """
+        Send a packet now through send(packet) -> bool, or queue it.
+        With delay or after the packet is only scheduled. Returns the entry id
+        while the packet is queued, None if it was sent immediately.
+        """
+        if after is not None and after in self.pending:
+            return self._queue(packet, None, after=after, delay=delay)
+        if delay:
+            return self._queue(packet, time.time() + delay)
+        if send(packet):
+            return None
+        EVENTS.inc('retried')
+        log.warning("Outbox: send failed, packet queued for retry in %s seconds", self._retry_delay(1))
+        return self._queue(packet, time.time() + self._retry_delay(1), attempts=1)
+
+    def next_due(self):
+        """Earliest due time of a queued packet, None if nothing is scheduled"""
+        due = [entry['due'] for entry in self.pending.values() if entry['due'] is not None]
+        return min(due) if due else None
+
+    def run_due(self, send, now=None):
+        """
+        Send every packet that is due, oldest first. Stops at the first failure
+        (the link is probably down) and reschedules that packet with backoff.
+        Returns the number of packets sent.
+        """
+        now = time.time() if now is None else now
+        due = sorted((entry for entry in self.pending.values()
+                      if entry['due'] is not None and entry['due'] <= now),
+                     key=lambda entry: (entry['due'], entry['id']))
+        sent = 0
+        for entry in due:
+            if now - entry['created'] > self.max_age:
+                log.warning("Outbox: dropping packet queued %.0f seconds ago: %s",
+                            now - entry['created'], entry['packet'])
+                EVENTS.inc('dropped')
+                self._done(entry)
+                continue
+            if not send(entry['packet']):
+                entry['attempts'] += 1
+                entry['due'] = time.time() + self._retry_delay(entry['attempts'])
+                EVENTS.inc('retried')
+                self._write({'op': 'update', 'id': entry['id'], 'due': entry['due'],
+                             'attempts': entry['attempts']})
+                break
+            sent += 1
+            EVENTS.inc('sent')
+            self._done(entry)
+
+        if self.records >= COMPACT_RECORDS or (not self.pending and self.records):
+            self._compact()
+        return sent
+
+    def _done(self, entry):
+        """Remove a sent or expired entry and release the entries waiting on it"""
+        del self.pending[entry['id']]
+        records = [{'op': 'done', 'id': entry['id']}]
+        for follower in self.pending.values():
+            if follower['after'] == entry['id'] and follower['due'] is None:
+                follower['due'] = time.time() + follower['delay']
+                records.append({'op': 'update', 'id': follower['id'], 'due': follower['due'],
+                                'attempts': follower['attempts']})
+        self._write(*records)
@@ -0,0 +1,246 @@
+# coding: utf-8
+# profiling.py - opt-in stage timings and an on-demand sampling profiler
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+from aprs_logging import get_logger
+from metrics import registry
+
+log = get_logger("profiling")
+
+# Per-stage timings of /meteo requests and daemon cycles (histograms, logs, Server-Timing)
+STAGES_ENABLED = os.getenv('APRS_PROFILE', 'off').lower() == 'on'
+PROFILE_DIR = os.getenv('APRS_PROFILE_DIR', "/config/profiles")
+SAMPLE_INTERVAL = float(os.getenv('APRS_PROFILE_INTERVAL', '0.005'))
+# A session started with SIGUSR1 is dumped after this long if no second SIGUSR1 arrives
+SAMPLE_MAX_SECONDS = 300
+
+STAGE_SECONDS = registry.histogram('aprs_stage_seconds', "Time spent per stage of a request or daemon cycle",
+                                   ('path', 'stage'))
+
+
+class StageTimer:
+    """Durations of the named stages of one request or cycle"""
+
+    def __init__(self, path, level=logging.DEBUG):
+        self.path = path
+        self.level = level
+        self.stages = []
+        self.started = self.last = time.perf_counter()
+
+    def __bool__(self):
+        return True
+
+    def lap(self, name):
+        """Close the stage running since the previous lap"""
+        now = time.perf_counter()
+        self.stages.append((name, now - self.last))
+        self.last = now
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def header(self):
+        """Server-Timing header value, durations in milliseconds"""
+        return ", ".join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in self.stages)
+
+    def finish(self):
+        total = time.perf_counter() - self.started
+        for name, seconds in self.stages:
+            STAGE_SECONDS.observe(seconds, self.path, name)
+        STAGE_SECONDS.observe(total, self.path, 'total')
+        log.log(self.level, "Stages %s: %s, total %.2f ms", self.path,
+                ", ".join(f"{name} {seconds * 1000:.2f} ms" for name, seconds in self.stages), total * 1000)
+
+
+class _Stage:
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.timer.stages.append((self.name, time.perf_counter() - self.started))
+        self.timer.last = time.perf_counter()
+        return False
+
+
+class _NullTimer:
+    """Stand-in used when stage timings are off; every call is a no-op"""
+
+    def __bool__(self):
+        return False
+
+    def lap(self, name):
+        pass
+
+    def stage(self, name):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def header(self):
+        return None
+
+    def finish(self):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+_local = threading.local()
+
+
+def begin(path, level=logging.DEBUG):
+    """Start timing a request or cycle in this thread; NULL_TIMER when timings are off"""
+    if not STAGES_ENABLED:
+        return NULL_TIMER
+    timer = _local.timer = StageTimer(path, level)
+    return timer
+
+
+def stage(name):
+    """Context manager timing a stage of the timer active in this thread, if any"""
+    timer = getattr(_local, 'timer', None)
+    return NULL_TIMER if timer is None else timer.stage(name)
+
+
+def current():
+    """Timer active in this thread, NULL_TIMER if none"""
+    return getattr(_local, 'timer', None) or NULL_TIMER
+
+
+def end():
+    """Record and log the timer active in this thread"""
+    timer = getattr(_local, 'timer', None)
+    if timer is not None:
+        _local.timer = None
+        timer.finish()
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread from a background thread and writes
+    them in collapsed format ("frame;frame;frame count" per line), readable
+    by flamegraph.pl, speedscope and similar tools.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL, directory=PROFILE_DIR):
+        self.interval = interval
+        self.directory = directory
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.name = "process"
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        if self.running:
+            return
+        self.counts.clear()
+        self.samples = 0
+        self.stop_event.clear()
+        self.started = time.time()
+        self.thread = threading.Thread(target=self._loop, name="SamplingProfiler", daemon=True)
+        self.thread.start()
+        log.info("Sampling profiler started (every %.1f ms); send SIGUSR1 again to write the profile",
+                 self.interval * 1000)
+
+    def _loop(self):
+        own = threading.get_ident()
+        names = {}
+        deadline = time.time() + SAMPLE_MAX_SECONDS
+        while not self.stop_event.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    key = names.get(code)
+                    if key is None:
+                        key = names[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    stack.append(key)
+                    frame = frame.f_back
+                self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+            if time.time() > deadline:
+                threading.Thread(target=self.stop, name="SamplingProfilerDump", daemon=True).start()
+                return
+
+    def stop(self):
+        """Stop sampling and write the collapsed stacks; returns the file path"""
+        if not self.running:
+            return None
+        self.stop_event.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+        path = os.path.join(self.directory, f"{self.name}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, 'w') as f:
+                for stack, count in self.counts.most_common():
+                    f.write(f"{stack} {count}\n")
+        except OSError as e:
+            log.error("Profile write error: %s", e)
+            return None
+        log.info("Sampling profile written to %s (%d samples over %.1f s)",
+                 path, self.samples, time.time() - self.started)
+        return path
+
+    def toggle(self, signum=None, frame=None):
+        # The dump is written from a thread: file I/O does not belong in a signal handler
+        if self.running:
+            threading.Thread(target=self.stop, name="SamplingProfilerDump", daemon=True).start()
+        else:
+            self.start()
+
+    def after_fork(self):
+        """The sampling thread does not survive fork"""
+        self.thread = None
+        self.stop_event = threading.Event()
+
+
+profiler = SamplingProfiler()
+os.register_at_fork(after_in_child=profiler.after_fork)
+
+
+def install_signal_handler(name):
+    """SIGUSR1 starts the sampling profiler, the next SIGUSR1 writes PROFILE_DIR/<name>-<pid>-<time>.folded"""
+    profiler.name = name
+    signal.signal(signal.SIGUSR1, profiler.toggle)
+
+
+def profile_call(name, func, *args):
+    """Run func under cProfile, write PROFILE_DIR/<name>-<time>.pstats and print the top entries"""
+    import cProfile
+    import pstats
+
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args)
+    finally:
+        path = os.path.join(PROFILE_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.pstats")
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profile.dump_stats(path)
+            print(f"Profile written to {path}", file=sys.stderr)
+        except OSError as e:
+            print(f"Profile write error: {e}", file=sys.stderr)
+        pstats.Stats(profile, stream=sys.stderr).sort_stats('cumulative').print_stats(25)
@@ -0,0 +1,109 @@
+# coding: utf-8
+# rate_limit.py - per-client token buckets for the ingest endpoints
+import collections
+import ipaddress
+import os
+import threading
+import time
+
+from aprs_logging import get_logger
+
+log = get_logger("rate_limit")
+
+# Sustained requests per second and burst size allowed per client (RATE_LIMIT_RATE=0 disables)
+RATE = float(os.getenv('RATE_LIMIT_RATE', '5'))
+BURST = float(os.getenv('RATE_LIMIT_BURST', '20'))
+# Per-client limits: "192.168.1.10=20/50, garden@192.168.1.20=1/5" (client=rate/burst);
+# a client is an address, or an X-Station-Key value bound to its source address
+CLIENT_LIMITS = os.getenv('RATE_LIMIT_CLIENTS', '')
+# Buckets kept in memory; the least recently seen client is evicted first
+MAX_CLIENTS = int(os.getenv('RATE_LIMIT_MAX_CLIENTS', '4096'))
+
+
+def parse_client_limits(value):
+    """
+    Parse "client=rate/burst, ..." into {client: (rate, burst)}.
+    Address clients are keyed by the address string, "key@address" clients
+    by the (station key, address) tuple, so the two never share a bucket.
+    """
+    limits = {}
+    for entry in value.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        client, sep, limit = entry.rpartition('=')
+        rate, _, burst = limit.partition('/')
+        try:
+            if not sep or not client.strip():
+                raise ValueError("expected client=rate/burst")
+            station_key, at, address = client.strip().rpartition('@')
+            # X-Station-Key is not authenticated: a key only counts from its own address
+            address = str(ipaddress.ip_address(address))
+            if at and not station_key:
+                raise ValueError("expected key@address")
+            rate = float(rate)
+            burst = float(burst) if burst else max(rate, 1.0)
+        except ValueError as e:
+            log.warning("Rate limit entry '%s' ignored: %s", entry, e)
+            continue
+        limits[(station_key, address) if at else address] = (rate, burst)
+    return limits
+
+
+class RateLimiter:
+    """
+    Token buckets keyed by client. A bucket holds up to `burst` tokens and
+    refills at `rate` tokens per second; each request takes one. Only
+    [tokens, last refill] is stored per client, in an LRU-ordered dict
+    bounded by max_clients.
+    Buckets live in the serving process: with several async workers a
+    client can get up to WEB_WORKERS times the configured rate.
+    """
+
+    def __init__(self, rate=RATE, burst=BURST, limits=None, max_clients=MAX_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.limits = dict(limits or {})
+        self.max_clients = max_clients
+        self.buckets = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.rate > 0 or bool(self.limits)
+
+    def client_key(self, remote_addr, station_key=None):
+        """
+        Bucket for a request: (station key, address) when that pair has its
+        own configured limit, otherwise the remote address. A key sent from
+        another address, or an unknown key, falls back to the address bucket,
+        so keys can neither be borrowed nor rotated to bypass the limit.
+        """
+        if station_key and (station_key, remote_addr) in self.limits:
+            return station_key, remote_addr
+        return remote_addr or '-'
+
+    def allow(self, key, now=None):
+        """Take a token for key. Returns 0 when allowed, else seconds until one is available"""
+        rate, burst = self.limits.get(key, (self.rate, self.burst))
+        if rate <= 0:
+            return 0
+        now = time.monotonic() if now is None else now
+        buckets = self.buckets
+        with self.lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                if len(buckets) >= self.max_clients:
+                    buckets.popitem(last=False)
+                bucket = buckets[key] = [burst, now]
+            else:
+                buckets.move_to_end(key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / rate
+
+
+limiter = RateLimiter(limits=parse_client_limits(CLIENT_LIMITS))
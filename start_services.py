@@ -1,39 +1,244 @@
 # coding: utf-8
 # start_services.py by N1k0droid\\IT9KVB update 14.08.25
+import importlib
 import multiprocessing
+import json
 import time
 import signal
 import sys
 import os
+from multiprocessing.connection import wait
 
-def run_flask_app():
-    """Start the Flask app to receive weather data"""
+from latest_observation import SERVICE_STATS_PATH as STATS_PATH
+from metrics import registry
+import profiling
+
+# Longest time the daemon waits for the receiver to accept connections
+RECEIVER_READY_TIMEOUT = 10
+# Restart delays double from RESTART_INITIAL up to RESTART_MAX seconds while a
+# service keeps crashing; a run longer than STABLE_RUN resets the delay
+RESTART_INITIAL = 0.5
+RESTART_MAX = 60
+STABLE_RUN = 60
+# More than CRASH_LOOP_LIMIT exits within CRASH_LOOP_WINDOW seconds pause the
+# service's restarts for CRASH_LOOP_PAUSE seconds
+CRASH_LOOP_LIMIT = 5
+CRASH_LOOP_WINDOW = 300
+CRASH_LOOP_PAUSE = 300
+
+RESTARTS = registry.counter('aprs_service_restarts_total', "Service processes restarted by the manager",
+                            ('service',))
+OUTAGE_SECONDS = registry.histogram('aprs_service_outage_seconds',
+                                    "Time from a service exit until its replacement is serving",
+                                    ('service',))
+
+def preload():
+    """
+    Import both services in the parent so the forked children start with
+    Flask and the sender already loaded. Returns the time spent in seconds.
+    """
+    started = time.perf_counter()
+    importlib.import_module('app')
+    importlib.import_module('aprs_send_daemon')
+    return time.perf_counter() - started
+
+def run_flask_app(ready=None):
+    """Start the Flask app to receive weather data
+    SERVER_MODE=dev uses the Werkzeug development server,
+    SERVER_MODE=async the pre-forked asyncio server (WEB_WORKERS processes)
+    ready is set once the receiver accepts connections.
+    """
     try:
-        from app import app
-        print("Starting Flask weather data receiver...")
-        app.run(host="0.0.0.0", port=5000, debug=False, use_reloader=False)
+        from app import app, flush_buffers
+        mode = os.getenv('SERVER_MODE', 'dev').lower()
+        if mode == 'async':
+            from async_server import serve
+            workers = int(os.getenv('WEB_WORKERS', '0')) or None
+            print("Starting async weather data receiver...")
+            # Each worker flushes its own buffers when terminated
+            serve(app, host="0.0.0.0", port=5000, workers=workers, ready=ready,
+                  on_exit=flush_buffers)
+        else:
+            from werkzeug.serving import make_server
+            print("Starting Flask weather data receiver...")
+            # Same server as app.run(), but bound before signalling readiness
+            server = make_server("0.0.0.0", 5000, app, threaded=True)
+            if ready is not None:
+                ready.set()
+            signal.signal(signal.SIGTERM, exit_on_signal)
+            signal.signal(signal.SIGINT, exit_on_signal)
+            try:
+                server.serve_forever()
+            finally:
+                flush_buffers()
     except Exception as e:
         print(f"Flask app error: {e}")
 
-def run_aprs_daemon():
-    """Start the APRS daemon"""
-    # Wait a few seconds to give Flask time to start
-    time.sleep(5)
+def run_aprs_daemon(ready=None, started_at=None):
+    """Start the APRS daemon once the receiver is ready"""
+    if ready is not None and not ready.wait(RECEIVER_READY_TIMEOUT):
+        print("Weather data receiver not ready, starting APRS daemon anyway")
     try:
         from aprs_send_daemon import APRSDaemon
         print("Starting APRS transmission daemon...")
-        daemon = APRSDaemon()
+        daemon = APRSDaemon(started_at=started_at)
         daemon.run()
     except Exception as e:
         print(f"APRS daemon error: {e}")
 
+def run_udp_ingest():
+    """Start the UDP datagram receiver (UDP_INGEST_PORT)"""
+    try:
+        from udp_ingest import UDPIngest
+        from app import flush_buffers
+        print("Starting UDP weather data receiver...")
+        try:
+            UDPIngest().run()
+        finally:
+            flush_buffers()
+    except Exception as e:
+        print(f"UDP ingest error: {e}")
+
+def exit_on_signal(signum, frame):
+    """Unwind through finally blocks so buffered data is written before exit"""
+    raise SystemExit(0)
+
+def run_service(target, *args):
+    """Child entry point: drop the manager's signal handlers before starting the service"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    # SIGUSR1 toggles the sampling profiler of this service
+    profiling.install_signal_handler(multiprocessing.current_process().name)
+    target(*args)
+
 class ServiceManager:
-    def __init__(self):
+    def __init__(self, startup_profile=False):
         self.processes = []
-        
+        self.startup_profile = startup_profile
+        self.started_at = time.time()
+        # Children are forked from the preloaded parent
+        self.ctx = multiprocessing.get_context('fork')
+        self.receiver_ready = self.ctx.Event()
+        self.stopping = False
+        # Per service: restart count, backoff, recent exits and downtime
+        self.services = {}
+
+    def spawn(self, name):
+        """Fork the FlaskApp, UDPIngest or APRSDaemon service process"""
+        if name == "FlaskApp":
+            self.receiver_ready.clear()
+            args = (run_flask_app, self.receiver_ready)
+        elif name == "UDPIngest":
+            args = (run_udp_ingest,)
+        else:
+            started_at = self.started_at if self.startup_profile else None
+            args = (run_aprs_daemon, self.receiver_ready, started_at)
+        process = self.ctx.Process(target=run_service, args=args, name=name)
+        process.start()
+
+        service = self.services.setdefault(name, {
+            'restarts': 0, 'backoff': 0.0, 'exits': [], 'down_since': None, 'restart_at': None,
+            'downtime_ms': 0.0, 'last_outage_ms': None, 'last_exit_code': None, 'last_exit': None,
+        })
+        service['process'] = process
+        service['started'] = time.time()
+        service['restart_at'] = None
+        return process
+
+    def on_exit(self, process):
+        """Record a service exit and schedule its restart with backoff"""
+        service = self.services[process.name]
+        now = time.time()
+        ran = now - service['started']
+        service['down_since'] = time.perf_counter()
+        service['last_exit_code'] = process.exitcode
+        service['last_exit'] = now
+        service['exits'] = [t for t in service['exits'] if now - t < CRASH_LOOP_WINDOW] + [now]
+
+        # The first exit in a while restarts at once, repeated ones back off
+        if ran >= STABLE_RUN or len(service['exits']) == 1:
+            service['backoff'] = 0.0
+        else:
+            service['backoff'] = min(service['backoff'] * 2 if service['backoff'] else RESTART_INITIAL,
+                                     RESTART_MAX)
+        delay = service['backoff']
+        if len(service['exits']) > CRASH_LOOP_LIMIT:
+            delay = CRASH_LOOP_PAUSE
+            print(f"Process {process.name} exited {len(service['exits'])} times in "
+                  f"{CRASH_LOOP_WINDOW} seconds, crash loop: next restart in {delay} seconds")
+        else:
+            print(f"Process {process.name} (PID: {process.pid}) died with exit code {process.exitcode} "
+                  f"after {ran:.1f} seconds, restarting in {delay:.1f} seconds...")
+        service['restart_at'] = time.perf_counter() + delay
+        self.write_stats()
+
+    def on_up(self, name):
+        """A restarted service is serving again: close its outage"""
+        service = self.services[name]
+        if service['down_since'] is None:
+            return
+        outage = (time.perf_counter() - service['down_since']) * 1000
+        service['down_since'] = None
+        service['downtime_ms'] += outage
+        service['last_outage_ms'] = outage
+        OUTAGE_SECONDS.observe(outage / 1000, name)
+        print(f"Service {name} back after {outage:.1f} ms")
+        self.write_stats()
+
+    def restart_due(self):
+        """Restart services whose backoff has elapsed; returns the next pending restart time"""
+        pending = None
+        for name, service in self.services.items():
+            if service['restart_at'] is None:
+                continue
+            if time.perf_counter() >= service['restart_at']:
+                old = service['process']
+                self.processes.remove(old)
+                new_process = self.spawn(name)
+                service['restarts'] += 1
+                RESTARTS.inc(name)
+                self.processes.append(new_process)
+                print(f"Restarted {name} (new PID: {new_process.pid})")
+                # The receiver is back once it accepts connections, the others once forked
+                if name != "FlaskApp":
+                    self.on_up(name)
+            else:
+                pending = service['restart_at'] if pending is None else min(pending, service['restart_at'])
+        return pending
+
+    def stats(self):
+        services = {}
+        for name, service in self.services.items():
+            outage = service['downtime_ms']
+            if service['down_since'] is not None:
+                outage += (time.perf_counter() - service['down_since']) * 1000
+            services[name] = {
+                'pid': service['process'].pid,
+                'up': service['down_since'] is None,
+                'restarts': service['restarts'],
+                'recent_exits': len(service['exits']),
+                'last_exit_code': service['last_exit_code'],
+                'last_exit': service['last_exit'],
+                'last_outage_ms': service['last_outage_ms'] and round(service['last_outage_ms'], 1),
+                'downtime_ms': round(outage, 1),
+                'backoff': service['backoff'],
+            }
+        return {'manager_pid': os.getpid(), 'started': self.started_at, 'services': services}
+
+    def write_stats(self):
+        """Publish the statistics for /status using an atomic rename"""
+        tmp_path = f"{STATS_PATH}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.stats(), f)
+            os.replace(tmp_path, STATS_PATH)
+        except OSError as e:
+            print(f"Service stats write error: {e}")
+
     def signal_handler(self, signum, frame):
         """Handle termination signals and stop all services cleanly"""
         print(f"Received shutdown signal {signum}")
+        self.stopping = True
         for process in self.processes:
             if process.is_alive():
                 process.terminate()
@@ -52,42 +257,61 @@ class ServiceManager:
         # Register clean shutdown handlers
         signal.signal(signal.SIGTERM, self.signal_handler)
         signal.signal(signal.SIGINT, self.signal_handler)
+        profiling.install_signal_handler("ServiceManager")
         
         print("Starting APRS Weather Station Services...")
+        preload_time = preload()
         
         # Start Flask in a separate process
-        flask_process = multiprocessing.Process(target=run_flask_app, name="FlaskApp")
-        flask_process.start()
+        flask_process = self.spawn("FlaskApp")
         self.processes.append(flask_process)
         print(f"Flask process started (PID: {flask_process.pid})")
+
+        # Optional UDP receiver for sensors pushing every few seconds
+        if int(os.getenv('UDP_INGEST_PORT', '0')):
+            udp_process = self.spawn("UDPIngest")
+            self.processes.append(udp_process)
+            print(f"UDP ingest process started (PID: {udp_process.pid})")
         
-        # Start APRS daemon in a separate process
-        aprs_process = multiprocessing.Process(target=run_aprs_daemon, name="APRSDaemon")
-        aprs_process.start()
+        # Start APRS daemon in a separate process; it waits for the receiver to be ready
+        aprs_process = self.spawn("APRSDaemon")
         self.processes.append(aprs_process)
         print(f"APRS daemon process started (PID: {aprs_process.pid})")
+
+        if self.startup_profile:
+            self.receiver_ready.wait(RECEIVER_READY_TIMEOUT)
+            print(f"Startup profile: preload {preload_time * 1000:.1f} ms, "
+                  f"receiver ready after {(time.time() - self.started_at) * 1000:.1f} ms")
         
+        self.write_stats()
         try:
-            # Keep the main process alive and monitor child processes
-            while True:
-                for process in list(self.processes):
-                    if not process.is_alive():
-                        print(f"Process {process.name} (PID: {process.pid}) died with exit code {process.exitcode}, restarting...")
-                        if process.name == "FlaskApp":
-                            new_process = multiprocessing.Process(target=run_flask_app, name="FlaskApp")
-                        else:
-                            new_process = multiprocessing.Process(target=run_aprs_daemon, name="APRSDaemon")
-                        
-                        new_process.start()
-                        self.processes.remove(process)
-                        self.processes.append(new_process)
-                        print(f"Restarted {new_process.name} (new PID: {new_process.pid})")
-                
-                time.sleep(30)  # Check every 30 seconds
-                
+            # Block on the children's sentinels: an exit is noticed within milliseconds
+            while not self.stopping:
+                timeout = None
+                pending = self.restart_due()
+                if pending is not None:
+                    timeout = max(0.0, pending - time.perf_counter())
+                # Poll the receiver's readiness while it is coming back
+                flask = self.services.get("FlaskApp")
+                if flask is not None and flask['down_since'] is not None and flask['restart_at'] is None:
+                    if self.receiver_ready.is_set():
+                        self.on_up("FlaskApp")
+                    else:
+                        starting = time.time() - flask['started'] < RECEIVER_READY_TIMEOUT
+                        poll = 0.005 if starting else 1.0
+                        timeout = poll if timeout is None else min(timeout, poll)
+
+                running = [service['process'] for service in self.services.values()
+                           if service['restart_at'] is None]
+                for sentinel in wait([process.sentinel for process in running], timeout):
+                    process = next(p for p in running if p.sentinel == sentinel)
+                    process.join()
+                    if not self.stopping:
+                        self.on_exit(process)
+
         except KeyboardInterrupt:
             self.signal_handler(signal.SIGINT, None)
 
 if __name__ == "__main__":
-    manager = ServiceManager()
+    manager = ServiceManager(startup_profile='--startup-profile' in sys.argv)
     manager.start()
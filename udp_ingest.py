@@ -0,0 +1,201 @@
+# coding: utf-8
+# udp_ingest.py - UDP datagram receiver for sensor nodes pushing every few seconds
+import hashlib
+import hmac
+import json
+import os
+import re
+import select
+import signal
+import socket
+import time
+
+from aprs_logging import get_logger
+from metrics import registry
+
+log = get_logger("udp_ingest")
+
+UDP_HOST = os.getenv('UDP_INGEST_HOST', "0.0.0.0")
+UDP_PORT = int(os.getenv('UDP_INGEST_PORT', '0'))      # 0 disables the listener
+# Shared secret: when set, every datagram is "<payload>|<unix time>|<hex HMAC-SHA256
+# of payload|unix time>"
+UDP_SECRET = os.getenv('UDP_INGEST_SECRET', '')
+# Signed datagrams whose time is further than this from ours are rejected;
+# within it, each signature is accepted once
+UDP_MAX_AGE = float(os.getenv('UDP_INGEST_MAX_AGE', '30'))
+MAX_DATAGRAM = 2048
+RECEIVE_BUFFER = 1 << 20
+# Datagrams handled before the latest observation is published
+MAX_BURST = 256
+
+DATAGRAMS = registry.counter('aprs_udp_datagrams_total', "UDP ingest datagrams by result", ('result',))
+
+# key=value pairs separated by '&', ';' or whitespace (',' is a decimal separator)
+_PAIR_SEPARATOR = re.compile(r'[&;\s]+')
+
+
+def sign(message, secret):
+    """
+    Signature a sensor appends to its datagram, where message is
+    payload + b'|' + unix time: message + b'|' + sign(message, secret)
+    """
+    return hmac.new(secret, message, hashlib.sha256).hexdigest().encode('ascii')
+
+
+def verify_datagram(datagram, secret):
+    """
+    Check the signature of a signed datagram.
+    Returns (payload, sender time, signature); raises PermissionError on a
+    missing or wrong signature, ValueError on a bad time.
+    """
+    message, separator, signature = datagram.rpartition(b'|')
+    signature = signature.strip().lower()
+    if not separator or not hmac.compare_digest(sign(message, secret), signature):
+        raise PermissionError("bad signature")
+    payload, separator, sent = message.rpartition(b'|')
+    if not separator:
+        raise PermissionError("bad signature")
+    return payload, float(sent), signature
+
+
+def parse_datagram(datagram):
+    """
+    Decode a datagram payload into a {field: value} dictionary.
+    Accepts a JSON object or key=value pairs ("temperature=21.5&humidity=60").
+    Raises ValueError on bad content.
+    """
+    text = datagram.decode('utf-8').strip()
+    if text.startswith('{'):
+        data = json.loads(text)
+        if not isinstance(data, dict):
+            raise ValueError("JSON datagram must be an object")
+        return data
+
+    data = {}
+    for pair in _PAIR_SEPARATOR.split(text):
+        if not pair:
+            continue
+        key, separator, value = pair.partition('=')
+        if not separator or not key:
+            raise ValueError(f"invalid pair '{pair}'")
+        data[key] = value
+    return data
+
+
+class UDPIngest:
+    """
+    Receive observations over UDP and feed them through the same validation
+    and storage as POST /meteo. Datagrams are drained in bursts; every sample
+    goes to the shared history (served by /history in the receiver) and the
+    archive, but only the newest of a burst is published to the shared
+    latest observation.
+    With a secret, a signed datagram is accepted once and only within
+    max_age seconds of its sender time, so captured datagrams cannot be
+    replayed, from any source address.
+    """
+
+    def __init__(self, host=UDP_HOST, port=UDP_PORT, secret=UDP_SECRET, max_age=UDP_MAX_AGE):
+        self.host = host
+        self.port = port
+        self.secret = secret.encode('utf-8') if secret else None
+        self.max_age = max_age
+        # signature -> sender time of the signed datagrams still within max_age
+        self.seen = {}
+        self.pruned_at = 0.0
+        self.sock = None
+        self.running = True
+        # Same validation and storage as the HTTP receiver
+        import app
+        self.app = app
+
+    def bind(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # Absorb bursts while a publish holds the loop
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+        except OSError:
+            pass
+        self.sock.bind((self.host, self.port))
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+        return self.sock
+
+    def fresh(self, sent, signature, now):
+        """True the first time a signature is seen within max_age of its sender time"""
+        if not abs(now - sent) <= self.max_age:
+            return False
+        if now - self.pruned_at > self.max_age:
+            # Older entries are rejected by age anyway
+            self.seen = {s: t for s, t in self.seen.items() if now - t <= self.max_age}
+            self.pruned_at = now
+        if signature in self.seen:
+            return False
+        self.seen[signature] = sent
+        return True
+
+    def handle(self, datagram, address):
+        """Validate and record one datagram; returns (timestamp, sample) or None"""
+        timestamp = time.time()
+        try:
+            if self.secret:
+                datagram, sent, signature = verify_datagram(datagram, self.secret)
+                if not self.fresh(sent, signature, timestamp):
+                    DATAGRAMS.inc('replayed')
+                    log.debug("UDP datagram from %s rejected: stale or repeated", address[0])
+                    return None
+            data = parse_datagram(datagram)
+        except PermissionError:
+            DATAGRAMS.inc('forged')
+            # debug only: a flood of forged datagrams must not flood the log
+            log.debug("UDP datagram from %s rejected: bad signature", address[0])
+            return None
+        except ValueError as e:     # includes UnicodeDecodeError and JSON errors
+            DATAGRAMS.inc('invalid')
+            log.debug("UDP datagram from %s rejected: %s", address[0], e)
+            return None
+
+        validated, rejected = self.app.validate_weather_data(data)
+        if not validated:
+            DATAGRAMS.inc('rejected')
+            return None
+        DATAGRAMS.inc('accepted')
+        return timestamp, self.app.record_observation(validated, timestamp, publish=False)
+
+    def receive_burst(self):
+        """Handle every queued datagram (up to MAX_BURST) and publish the newest sample"""
+        newest = None
+        for _ in range(MAX_BURST):
+            try:
+                datagram, address = self.sock.recvfrom(MAX_DATAGRAM)
+            except BlockingIOError:
+                break
+            sample = self.handle(datagram, address)
+            if sample is not None:
+                newest = sample
+        if newest is not None:
+            timestamp, observation = newest
+            try:
+                self.app.latest.publish(observation, timestamp)
+            except Exception as e:
+                log.error("Data save error: %s", e)
+
+    def stop(self, signum=None, frame=None):
+        self.running = False
+
+    def run(self, ready=None):
+        if self.sock is None:
+            self.bind()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        log.info("UDP ingest listening on %s:%s%s", self.host, self.port,
+                 " (HMAC required)" if self.secret else "")
+        if ready is not None:
+            ready.set()
+        while self.running:
+            try:
+                readable, _, _ = select.select([self.sock], [], [], 1.0)
+            except InterruptedError:
+                continue
+            if readable:
+                self.receive_burst()
+        self.sock.close()
@@ -0,0 +1,140 @@
+# coding: utf-8
+# wx_aggregates.py - sliding-window rain totals and wind gust from raw sensor samples
+import os
+import time
+from collections import deque
+
+from aprs_logging import get_logger
+
+log = get_logger("wx_aggregates")
+
+RAIN_MM_PER_TIP = float(os.getenv('RAIN_MM_PER_TIP', '0.2794'))   # 0.011 in bucket
+GUST_WINDOW = 600                                                  # APRS gust: peak of last 10 minutes
+
+# Raw inputs consumed by the aggregator and not forwarded as observation fields
+RAW_FIELDS = ('rain_tips', 'rain_counter')
+
+
+class RollingSum:
+    """Sum of the values added during the last `window` seconds, O(1) amortized per sample"""
+
+    def __init__(self, window):
+        self.window = window
+        self.samples = deque()
+        self.total = 0.0
+
+    def add(self, timestamp, value):
+        self.samples.append((timestamp, value))
+        self.total += value
+        self._evict(timestamp)
+
+    def _evict(self, now):
+        limit = now - self.window
+        samples = self.samples
+        while samples and samples[0][0] <= limit:
+            self.total -= samples.popleft()[1]
+        if not samples:
+            self.total = 0.0    # drop accumulated float error
+
+    def value(self, now):
+        self._evict(now)
+        return max(self.total, 0.0)
+
+
+class RollingMax:
+    """Maximum over the last `window` seconds using a monotonic deque"""
+
+    def __init__(self, window):
+        self.window = window
+        self.samples = deque()
+
+    def add(self, timestamp, value):
+        samples = self.samples
+        while samples and samples[-1][1] <= value:
+            samples.pop()
+        samples.append((timestamp, value))
+        self._evict(timestamp)
+
+    def _evict(self, now):
+        limit = now - self.window
+        samples = self.samples
+        while samples and samples[0][0] <= limit:
+            samples.popleft()
+
+    def value(self, now):
+        self._evict(now)
+        return self.samples[0][1] if self.samples else None
+
+
+class SinceMidnightSum:
+    """Running total reset at local midnight"""
+
+    def __init__(self):
+        self.day = None
+        self.total = 0.0
+
+    def _roll(self, timestamp):
+        day = time.localtime(timestamp)[:3]
+        if day != self.day:
+            self.day = day
+            self.total = 0.0
+
+    def add(self, timestamp, value):
+        self._roll(timestamp)
+        self.total += value
+
+    def value(self, now):
+        self._roll(now)
+        return self.total
+
+
+class WeatherAggregator:
+    """
+    Derive rain_1h, rain_24h, rain_midnight and wind_gust from the raw samples
+    of the shared observation history:
+    - rain_tips: bucket tips per sample (a rain_counter is converted when stored)
+    - wind_speed: instantaneous wind, used for wind_gust when no gust is sent
+    One aggregator runs in the daemon: it consumes the samples stored by every
+    receiver process and evaluates the windows when a packet is encoded.
+    Values sent precomputed by the sensor are left untouched.
+    """
+
+    def __init__(self, mm_per_tip=RAIN_MM_PER_TIP, gust_window=GUST_WINDOW):
+        self.mm_per_tip = mm_per_tip
+        self.rain_1h = RollingSum(3600)
+        self.rain_24h = RollingSum(86400)
+        self.rain_midnight = SinceMidnightSum()
+        self.gust = RollingMax(gust_window)
+        self.has_rain = False
+        self.cursor = 0     # history samples consumed so far
+
+    def update(self, history):
+        """Add the samples stored in the history since the previous call"""
+        cursor, missed, samples = history.read_since(self.cursor, ('rain_tips', 'wind_speed', 'wind_gust'))
+        if missed and self.cursor:
+            log.warning("%d samples were overwritten in the history before being aggregated, "
+                        "consider a larger HISTORY_CAPACITY", missed)
+        self.cursor = cursor
+        for timestamp, tips, wind_speed, wind_gust in samples:
+            if tips is not None:
+                self.has_rain = True
+                mm = tips * self.mm_per_tip
+                self.rain_1h.add(timestamp, mm)
+                self.rain_24h.add(timestamp, mm)
+                self.rain_midnight.add(timestamp, mm)
+            if wind_speed is not None and wind_gust is None:
+                self.gust.add(timestamp, wind_speed)
+
+    def apply(self, data, now=None):
+        """Return a copy of an observation with raw inputs replaced by the window values at now"""
+        now = time.time() if now is None else now
+        result = {k: v for k, v in data.items() if k not in RAW_FIELDS}
+        if self.has_rain:
+            result.setdefault('rain_1h', round(self.rain_1h.value(now), 2))
+            result.setdefault('rain_24h', round(self.rain_24h.value(now), 2))
+            result.setdefault('rain_midnight', round(self.rain_midnight.value(now), 2))
+        if 'wind_gust' not in result:
+            gust = self.gust.value(now)
+            if gust is not None:
+                result['wind_gust'] = gust
+        return result